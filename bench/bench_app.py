@@ -0,0 +1,356 @@
+"""整体基准：在子进程里启动应用 (临时 NOVELS_DIR)，配上假模型和本地小站，按并发压各个接口。
+
+用法：python bench/bench_app.py [--concurrency 8] [--requests 100] [--chapters 500] [--latency 0.5] [--rate-429 0]
+                               [--scenarios import_url,upload,crawl,novel,read,translate,stream] [--compare SHA 或 JSON 路径]
+
+- import_url：单页导入 fixtures/html 里保存的网页 (每次换个标题，各建一本)
+- upload：上传生成的大 TXT / EPUB，计到后台切章写库完成为止
+- crawl：整本抓取本地的 syosetu 风格小站 (目录分页 + 各话页面)
+- novel / read：目录页、阅读页
+- translate：/translate_api，模型是 bench/mock_llm.py (延迟、429 可调)
+- stream：/translate_stream，读完 SSE 后检查保存的译文 (假模型把每个字都译成「译」，出现别的字就是解码出错)
+
+报告每个场景的 p50 / p99 延迟和吞吐量，以及应用进程的峰值内存 (/proc/<pid>/status 的 VmHWM)。
+结果写到 bench/results/<git sha>.json (工作区有改动时加 -dirty)，--compare 可以和别的提交对比。
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import gen_fixtures  # noqa: E402
+
+HTML_FIXTURES = os.path.join(BENCH_DIR, "fixtures", "html")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SCENARIOS = ["import_url", "upload", "crawl", "novel", "read", "translate", "stream"]
+# 假模型不是真服务商，默认把应用的限速放开，测的是应用本身；要测限速逻辑可以用 --app-env 改回来
+DEFAULT_APP_ENV = {"OPENAI_RPM": "60000", "CRAWL_HOST_INTERVAL": "0", "SYNC_INTERVAL_HOURS": "0"}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    """(短 sha, 工作区是否有未提交的改动)"""
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, text=True).strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def percentile(samples, q):
+    if not samples: return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def peak_rss_mb(pid):
+    """进程到目前为止的峰值常驻内存；不是 Linux 时返回 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+# ---- 本地小站：保存的网页 + 生成的 syosetu 目录 / 章节 ----
+class SiteHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        m = re.fullmatch(r"/bench/(\d+)/", parsed.path)
+        if parsed.path.startswith("/page/"):
+            name = os.path.basename(parsed.path)
+            path = os.path.join(HTML_FIXTURES, name)
+            if not name.endswith(".html") or not os.path.exists(path): return self.send_error(404)
+            with open(path, encoding="utf-8") as f: page = f.read()
+            # 标题带上序号，每次导入都会建一本新书
+            page = page.replace("<title>", f"<title>#{query.get('n', ['0'])[0]} ", 1)
+        elif parsed.path == "/bench/":
+            page = gen_fixtures.syosetu_index(self.server.chapters, page=int(query.get("p", ["1"])[0]))
+        elif m and 1 <= int(m.group(1)) <= self.server.chapters:
+            page = gen_fixtures.syosetu_chapter(int(m.group(1)), self.server.chars)
+        else:
+            return self.send_error(404)
+        body = page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_site(chapters, chars):
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), SiteHandler)
+    server.daemon_threads = True
+    server.chapters, server.chars = chapters, chars
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def wait_http(url, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None: raise RuntimeError(f"进程已退出 ({proc.returncode})：{url}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"等待超时：{url}")
+
+
+# ---- 压测 ----
+_local = threading.local()
+
+
+def session():
+    if not hasattr(_local, "session"): _local.session = requests.Session()
+    return _local.session
+
+
+def run_load(fn, items, concurrency):
+    """并发跑 fn(item)，返回每个请求的耗时统计；fn 抛异常算失败"""
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def one(item):
+        started = time.perf_counter()
+        try:
+            fn(item)
+        except Exception as e:
+            with lock: errors.append(str(e)[:200])
+            return
+        with lock: latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool: list(pool.map(one, items))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(items), "errors": len(errors), "first_error": errors[0] if errors else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "seconds": round(elapsed, 2),
+    }
+
+
+def checked(resp):
+    if resp.status_code >= 400: raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+    return resp
+
+
+def wait_until(url, done, timeout):
+    """轮询后台状态接口，直到 done(状态) 为真"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        state = session().get(url, timeout=10).json()
+        if done(state): return state
+        time.sleep(0.2)
+    raise RuntimeError(f"等待后台任务超时：{url}")
+
+
+def bench_upload(app, path, timeout):
+    """上传一个大文件：记录上传请求本身和后台导入完成的耗时"""
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        novel_id = checked(session().post(f"{app}/upload", files={"file": (os.path.basename(path), f)}, timeout=300)).json()["id"]
+    upload_s = time.perf_counter() - started
+    state = wait_until(f"{app}/novel/{novel_id}/import", lambda s: s.get("status") in ("done", "failed"), timeout)
+    total_s = time.perf_counter() - started
+    if state["status"] != "done": raise RuntimeError(state.get("error"))
+    return novel_id, {"upload_ms": round(upload_s * 1000, 1), "import_seconds": round(total_s, 2),
+                      "chapters": state["chapters"], "chapters_per_s": round(state["chapters"] / total_s, 1),
+                      "mb_per_s": round(os.path.getsize(path) / 1024 / 1024 / total_s, 2)}
+
+
+def bench_crawl(app, site, timeout):
+    started = time.perf_counter()
+    novel_id = checked(session().post(f"{app}/import_url", json={"url": f"{site}/bench/", "crawl": True}, timeout=120)).json()["id"]
+    state = wait_until(f"{app}/novel/{novel_id}/crawl", lambda s: s.get("status") != "running", timeout)
+    elapsed = time.perf_counter() - started
+    return {"seconds": round(elapsed, 2), "chapters": state["done"], "failed": state.get("failed", 0),
+            "chapters_per_s": round(state["done"] / elapsed, 1)}
+
+
+def bench_stream(app, novel_id, settings, idx):
+    """流式翻译一章，再读回保存下来的译文：只能有「译」和空白"""
+    with session().post(f"{app}/translate_stream", json={**settings, "novel_id": novel_id, "chapter_index": idx},
+                        stream=True, timeout=300) as resp:
+        body = checked(resp).content.decode("utf-8")
+    if "event: done" not in body: raise RuntimeError(f"流式翻译没有完成：{body[-200:]}")
+    saved = checked(session().get(f"{app}/read/{novel_id}/{idx}/text", params={"part": "translation"}, timeout=60)).json()["text"]
+    wrong = set(saved) - {"译"} - set(" \u3000\n")
+    if not saved.strip() or wrong: raise RuntimeError(f"第 {idx} 章保存的译文不对：{''.join(sorted(wrong))[:50] or '(空)'}")
+
+
+def run(args):
+    work = tempfile.mkdtemp(prefix="bench_app_")
+    novels_dir = os.path.join(work, "novels")
+    procs = []
+    try:
+        print(f"生成 fixtures：{args.chapters} 章 × {args.chars} 字 ...", flush=True)
+        txt = gen_fixtures.make_txt(os.path.join(work, "bench.txt"), args.chapters, args.chars)
+        epub = gen_fixtures.make_epub(os.path.join(work, "bench.epub"), args.chapters, args.chars)
+        site = start_site(args.crawl_chapters, args.chars)
+
+        llm_port = free_port()
+        procs.append(subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "mock_llm.py"), "--port", str(llm_port),
+                                       "--latency", str(args.latency), "--rate-429", str(args.rate_429)],
+                                      stdout=subprocess.DEVNULL))
+        llm = f"http://127.0.0.1:{llm_port}"
+        wait_http(f"{llm}/stats", procs[-1])
+
+        app_port = free_port()
+        env = {**os.environ, **DEFAULT_APP_ENV, **dict(kv.split("=", 1) for kv in args.app_env),
+               "NOVELS_DIR": novels_dir, "PORT": str(app_port), "PYTHONWARNINGS": "ignore"}
+        app_proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], env=env, cwd=work,
+                                    stdout=subprocess.DEVNULL, stderr=open(os.path.join(work, "app.log"), "w"))
+        procs.append(app_proc)
+        app = f"http://127.0.0.1:{app_port}"
+        wait_http(app + "/", app_proc)
+        print(f"应用 pid {app_proc.pid}，并发 {args.concurrency}，每个场景 {args.requests} 次请求", flush=True)
+
+        results = {}
+        # upload 既是被测场景，也给 novel / read / translate 准备数据
+        novel_id, upload_txt = bench_upload(app, txt, args.timeout)
+        if "upload" in args.scenarios:
+            _, upload_epub = bench_upload(app, epub, args.timeout)
+            results["upload"] = {"txt": upload_txt, "epub": upload_epub}
+        chapters = upload_txt["chapters"]
+
+        if "import_url" in args.scenarios:
+            pages = sorted(n for n in os.listdir(HTML_FIXTURES) if n.endswith(".html"))
+            results["import_url"] = run_load(
+                lambda i: checked(session().post(f"{app}/import_url", json={"url": f"{site}/page/{pages[i % len(pages)]}?n={i}"}, timeout=60)),
+                list(range(args.requests)), args.concurrency)
+        if "crawl" in args.scenarios:
+            results["crawl"] = bench_crawl(app, site, args.timeout)
+        if "novel" in args.scenarios:
+            results["novel"] = run_load(lambda _: checked(session().get(f"{app}/novel/{novel_id}", timeout=60)),
+                                        list(range(args.requests)), args.concurrency)
+        if "read" in args.scenarios:
+            rng = random.Random(0)
+            results["read"] = run_load(lambda idx: checked(session().get(f"{app}/read/{novel_id}/{idx}", timeout=60)),
+                                       [rng.randint(1, chapters) for _ in range(args.requests)], args.concurrency)
+        if "translate" in args.scenarios:
+            settings = {"provider": "deepseek", "model": "mock", "api_key": "bench", "base_url": llm}
+            results["translate"] = run_load(
+                lambda idx: checked(session().post(f"{app}/translate_api", json={**settings, "novel_id": novel_id, "chapter_index": idx}, timeout=300)),
+                list(range(1, min(args.requests, chapters) + 1)), args.concurrency)
+            results["translate"]["mock_llm"] = requests.get(f"{llm}/stats", timeout=5).json()
+        if "stream" in args.scenarios:
+            settings = {"provider": "deepseek", "model": "mock", "api_key": "bench", "base_url": llm}
+            # 从最后一章往前取，不和 translate 场景翻过的章节重叠
+            results["stream"] = run_load(lambda idx: bench_stream(app, novel_id, settings, idx),
+                                         list(range(chapters, max(0, chapters - args.requests), -1)), args.concurrency)
+
+        sha, dirty = git_revision()
+        return {
+            "commit": sha, "dirty": dirty, "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+            "config": {k: v for k, v in vars(args).items() if k not in ("compare", "out")},
+            "peak_rss_mb": peak_rss_mb(app_proc.pid), "scenarios": results,
+        }
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if args.keep: print(f"工作目录保留在 {work}")
+        else: shutil.rmtree(work, ignore_errors=True)
+
+
+# ---- 输出 & 对比 ----
+def flat_metrics(result):
+    """把结果摊平成 {(场景, 指标): 数值}，方便对比"""
+    rows = {}
+    for name, data in result["scenarios"].items():
+        parts = data.items() if name == "upload" else [(None, data)]
+        for sub, values in parts:
+            label = f"{name}.{sub}" if sub else name
+            for key in ("p50_ms", "p99_ms", "throughput_rps", "chapters_per_s", "import_seconds", "seconds", "errors"):
+                if values.get(key) is not None: rows[(label, key)] = values[key]
+    rows[("process", "peak_rss_mb")] = result.get("peak_rss_mb")
+    return rows
+
+
+def print_report(result, baseline=None):
+    base = flat_metrics(baseline) if baseline else {}
+    title = f"commit {result['commit']}{' (dirty)' if result['dirty'] else ''}"
+    if baseline: title += f"  vs  {baseline['commit']}{' (dirty)' if baseline['dirty'] else ''}"
+    print("\n" + title)
+    print(f"{'scenario':<16}{'metric':<16}{'value':>12}" + (f"{'baseline':>12}{'change':>10}" if baseline else ""))
+    for (label, key), value in flat_metrics(result).items():
+        line = f"{label:<16}{key:<16}{value if value is not None else '-':>12}"
+        old = base.get((label, key))
+        if baseline:
+            change = f"{(value - old) / old * 100:+.1f}%" if old and value is not None else "-"
+            line += f"{old if old is not None else '-':>12}{change:>10}"
+        print(line)
+
+
+def load_result(ref):
+    """--compare 的参数：结果文件路径，或 bench/results 下的 sha"""
+    path = ref if os.path.exists(ref) else os.path.join(RESULTS_DIR, ref + ".json")
+    with open(path, encoding="utf-8") as f: return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="每个场景的请求数")
+    parser.add_argument("--chapters", type=int, default=500, help="上传用的 TXT / EPUB 章数")
+    parser.add_argument("--crawl-chapters", type=int, default=100, help="本地小站的话数")
+    parser.add_argument("--chars", type=int, default=4000, help="每章大约的字数")
+    parser.add_argument("--latency", type=float, default=0.5, help="假模型的响应延迟 (秒)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="假模型返回 429 的概率")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), type=lambda s: [x for x in s.split(",") if x])
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="传给应用的环境变量，可重复")
+    parser.add_argument("--timeout", type=float, default=600, help="等待后台导入 / 抓取的上限 (秒)")
+    parser.add_argument("--out", help="结果文件路径，默认 bench/results/<sha>.json")
+    parser.add_argument("--compare", help="对比的基线：结果文件路径或 sha")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录 (含应用日志)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown: parser.error(f"未知场景：{', '.join(sorted(unknown))}")
+
+    result = run(args)
+    out = args.out or os.path.join(RESULTS_DIR, result["commit"] + ("-dirty" if result["dirty"] else "") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=2)
+    print_report(result, load_result(args.compare) if args.compare else None)
+    print(f"\n结果已写入 {out}")
+
+
+if __name__ == "__main__":
+    main()
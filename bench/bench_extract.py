@@ -0,0 +1,110 @@
+"""正文提取基准：对比 V6 (旧算法) 和当前 intelligent_extract 的耗时与提取质量。
+
+用法：python bench/bench_extract.py [--repeat 20] [--deep 400]
+
+fixtures/html 下每个 *.html 对应一个 *.expected.txt (人工确认过的正文)。
+质量按「行」计算：正文里非空的行有多少被提取到 (recall)，提取结果里有多少行是正文 (precision)。
+--deep 会额外生成一个嵌套很深的页面，专门看 V6 的平方级开销。
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+os.environ.setdefault("NOVELS_DIR", tempfile.mkdtemp(prefix="bench_novels_"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bs4 import BeautifulSoup  # noqa: E402
+import main  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "html")
+
+
+def extract_v6(soup):
+    """V6 暴力比对算法 (原样保留，用于对比)"""
+    candidates = []
+    selectors = ["#novel_honbun", ".novel_view", ".entry-content", "#content", ".p-novel__body", ".js-novel-text", "article"]
+    for selector in selectors:
+        element = soup.select_one(selector)
+        if element:
+            text = element.get_text(separator="\n")
+            if len(text) > 200: candidates.append(text)
+
+    all_divs = soup.find_all("div")
+    if all_divs:
+        sorted_divs = sorted(all_divs, key=lambda d: len(d.get_text()), reverse=True)[:3]
+        for div in sorted_divs:
+            text = div.get_text(separator="\n")
+            if len(text) > 200: candidates.append(text)
+
+    if not candidates:
+        body_text = soup.body.get_text(separator="\n") if soup.body else ""
+        return body_text if len(body_text) > 100 else None
+    return max(candidates, key=len)
+
+
+def lines(text):
+    return {line.strip() for line in (text or "").split("\n") if line.strip()}
+
+
+def quality(expected, got):
+    exp, out = lines(expected), lines(got)
+    hit = len(exp & out)
+    recall = hit / len(exp) if exp else 1.0
+    precision = hit / len(out) if out else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
+def deep_page(depth):
+    """每层都有一点导航文字的深层嵌套页面，正文在最里面"""
+    head = "".join(f'<div class="d{i}"><a href="/n/{i}">ナビ{i}</a>' for i in range(depth))
+    body = "".join(f"<p>深い入れ子の本文 {i} 行目です。</p>" for i in range(200))
+    return f"<html><body>{head}<div class='text'>{body}</div>{'</div>' * depth}</body></html>"
+
+
+def timed(fn, html, parser, repeat):
+    """返回 (解析+提取的中位耗时 ms, 提取结果)"""
+    samples, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(BeautifulSoup(html, parser))
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), result
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--deep", type=int, default=400, help="深层嵌套页面的层数，0 表示不测")
+    args = parser.parse_args()
+
+    cases = []
+    for name in sorted(os.listdir(FIXTURES)):
+        if not name.endswith(".html"): continue
+        with open(os.path.join(FIXTURES, name), encoding="utf-8") as f: html = f.read()
+        with open(os.path.join(FIXTURES, name[:-5] + ".expected.txt"), encoding="utf-8") as f: expected = f.read()
+        cases.append((name[:-5], html, expected))
+    if args.deep: cases.append((f"deep_nested_{args.deep}", deep_page(args.deep), None))
+
+    print(f"parser: V6 = html.parser, V7 = {main.HTML_PARSER}, repeat = {args.repeat}")
+    print(f"{'fixture':<22}{'V6 ms':>9}{'V7 ms':>9}{'speedup':>9}   {'V6 P/R/F1':<18}{'V7 P/R/F1':<18}")
+    totals = [0.0, 0.0]
+    for name, html, expected in cases:
+        old_ms, old = timed(extract_v6, html, "html.parser", args.repeat)
+        new_ms, new = timed(main.intelligent_extract, html, main.HTML_PARSER, args.repeat)
+        totals[0] += old_ms
+        totals[1] += new_ms
+        if expected is None:
+            q_old = q_new = "-"
+        else:
+            q_old = "%.2f/%.2f/%.2f" % quality(expected, old)
+            q_new = "%.2f/%.2f/%.2f" % quality(expected, new)
+        print(f"{name:<22}{old_ms:>9.1f}{new_ms:>9.1f}{old_ms / new_ms:>8.1f}x   {q_old:<18}{q_new:<18}")
+    print(f"{'total':<22}{totals[0]:>9.1f}{totals[1]:>9.1f}{totals[0] / totals[1]:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,92 @@
+"""生成基准测试用的大文件：TXT、EPUB，以及一个 syosetu 风格的静态小站 (目录页 + 各话页面)。
+
+用法：python bench/gen_fixtures.py OUT_DIR [--chapters 2000] [--chars 4000]
+
+每章的每一行都带章号和行号，保证不同章节的段落互不相同 (不会被译文缓存「作弊」命中)。
+"""
+import os
+import html
+import random
+import zipfile
+import argparse
+
+WORDS = ["少女は", "静かに", "扉を開けた。", "遠くで", "鐘の音が", "響いている。", "「行こう」と", "彼は言った。",
+         "森の奥には", "古い塔が", "あるらしい。", "風が", "頬を撫でる。", "魔法陣が", "淡く光った。"]
+
+
+def chapter_lines(n, chars, seed=0):
+    """第 n 章的正文行，总长约 chars 字"""
+    rng = random.Random(n * 7919 + seed)
+    lines, total, i = [], 0, 0
+    while total < chars:
+        i += 1
+        line = f"{n}-{i} " + "".join(rng.choice(WORDS) for _ in range(rng.randint(3, 9)))
+        lines.append(line)
+        total += len(line)
+    return lines
+
+
+def make_txt(path, chapters, chars):
+    """「第N章 标题」开头的 TXT，一章一章写，不在内存里拼整本"""
+    with open(path, "w", encoding="utf-8") as f:
+        for n in range(1, chapters + 1):
+            f.write(f"第{n}章 ベンチマーク{n}\n\n")
+            f.write("\n\n".join(chapter_lines(n, chars)) + "\n\n")
+    return path
+
+
+def make_epub(path, chapters, chars):
+    """最小可用的 EPUB 3：container.xml + OPF + 每章一个 XHTML"""
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml",
+                    '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                    '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        for n in range(1, chapters + 1):
+            body = "".join(f"<p>{html.escape(line)}</p>" for line in chapter_lines(n, chars, seed=1))
+            zf.writestr(f"OEBPS/c{n}.xhtml",
+                        f'<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml"><head><title>{n}</title></head>'
+                        f"<body><h2>第{n}話 ベンチマーク</h2>{body}</body></html>")
+        manifest = "".join(f'<item id="c{n}" href="c{n}.xhtml" media-type="application/xhtml+xml"/>' for n in range(1, chapters + 1))
+        spine = "".join(f'<itemref idref="c{n}"/>' for n in range(1, chapters + 1))
+        zf.writestr("OEBPS/content.opf",
+                    '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+                    '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier id="id">bench</dc:identifier>'
+                    f'<dc:title>bench</dc:title><dc:language>ja</dc:language></metadata><manifest>{manifest}</manifest>'
+                    f"<spine>{spine}</spine></package>")
+    return path
+
+
+def syosetu_index(chapters, per_page=100, page=1):
+    """新版 syosetu 的目录页 (p-eplist)，超过 per_page 话时分页"""
+    start = (page - 1) * per_page + 1
+    items = "".join(f'<div class="p-eplist__sublist"><a href="/bench/{n}/" class="p-eplist__subtitle">第{n}話 ベンチマーク</a>'
+                    f'<div class="p-eplist__update">2024/01/{n % 28 + 1:02d} 12:00</div></div>'
+                    for n in range(start, min(chapters, start + per_page - 1) + 1))
+    pager = f'<a href="/bench/?p={page + 1}" class="c-pager__item c-pager__item--next">次へ</a>' if start + per_page <= chapters else ""
+    return (f'<!DOCTYPE html><html lang="ja"><head><meta charset="UTF-8"><title>ベンチマーク小説</title></head><body>'
+            f'<h1 class="p-novel__title">ベンチマーク小説</h1><div class="p-eplist">{items}</div>{pager}</body></html>')
+
+
+def syosetu_chapter(n, chars):
+    body = "".join(f'<p id="L{i}">{html.escape(line)}</p>' for i, line in enumerate(chapter_lines(n, chars, seed=2), 1))
+    return (f'<!DOCTYPE html><html lang="ja"><head><meta charset="UTF-8"><title>第{n}話 - ベンチマーク小説</title></head><body>'
+            f'<div class="l-header"><a href="/">小説家になろう</a> <a href="/bench/">目次</a></div>'
+            f'<h1 class="p-novel__title">第{n}話 ベンチマーク</h1>'
+            f'<div class="js-novel-text p-novel__text">{body}</div>'
+            f'<div class="c-pager"><a href="/bench/{n + 1}/" class="c-pager__item--next">次へ</a></div></body></html>')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--chapters", type=int, default=2000)
+    parser.add_argument("--chars", type=int, default=4000, help="每章大约的字数")
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    print(make_txt(os.path.join(args.out_dir, "bench.txt"), args.chapters, args.chars))
+    print(make_epub(os.path.join(args.out_dir, "bench.epub"), args.chapters, args.chars))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""OpenAI 兼容的本地假模型服务，给基准测试用：不需要真 Key，延迟、流式分块、429 都可以调。
+
+用法：python bench/mock_llm.py [--port 18600] [--latency 0.5] [--jitter 0.1] [--rate-429 0.05]
+
+POST /chat/completions：把提示词里的原文逐字「翻译」成等长的中文占位文本。
+- 非流式：等 latency (± jitter) 秒后一次性返回，带 usage
+- 流式：先等 ttft 秒，然后每 chunk-delay 秒发 chunk-chars 个字，最后一块带 usage
+- 按 rate-429 的概率直接返回 429 (带 Retry-After)，模拟被限速
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockLLM(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, latency=0.5, jitter=0.1, ttft=0.2, chunk_delay=0.02, chunk_chars=8,
+                 rate_429=0.0, retry_after=1):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.latency, self.jitter, self.ttft = latency, jitter, ttft
+        self.chunk_delay, self.chunk_chars = chunk_delay, chunk_chars
+        self.rate_429, self.retry_after = rate_429, retry_after
+        self.stats = {"requests": 0, "throttled": 0, "streams": 0}
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock: self.stats[key] += 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # GET /stats：看一下收到了多少请求、注入了多少次 429
+        with self.server.lock: self.send_json(200, dict(self.server.stats))
+
+    def do_POST(self):
+        srv = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        srv.count("requests")
+        if random.random() < srv.rate_429:
+            srv.count("throttled")
+            self.send_json(429, {"error": {"message": "rate limited (mock)"}}, {"Retry-After": str(srv.retry_after)})
+            return
+        prompt = payload["messages"][-1]["content"]
+        # 原文在提示词说明之后的第一个空行后面 (说明里提到了术语标记)
+        _, marker, rest = prompt.partition("<<<术语>>>")
+        source = (rest if marker else prompt).split("\n\n", 1)[-1]
+        text = "".join("译" if not ch.isspace() else ch for ch in source)
+        usage = {"prompt_tokens": len(prompt), "completion_tokens": len(text), "total_tokens": len(prompt) + len(text)}
+        if not payload.get("stream"):
+            time.sleep(max(0.0, srv.latency + random.uniform(-srv.jitter, srv.jitter)))
+            self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage})
+            return
+
+        srv.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(srv.ttft)
+        for i in range(0, len(text), srv.chunk_chars):
+            chunk = {"choices": [{"delta": {"content": text[i:i + srv.chunk_chars]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(srv.chunk_delay)
+        self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n".encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=18600)
+    parser.add_argument("--latency", type=float, default=0.5, help="非流式响应的延迟 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--ttft", type=float, default=0.2, help="流式响应的首字延迟 (秒)")
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--chunk-chars", type=int, default=8)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    server = MockLLM(args.port, args.latency, args.jitter, args.ttft, args.chunk_delay, args.chunk_chars,
+                     args.rate_429, args.retry_after)
+    print(f"mock LLM: http://127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
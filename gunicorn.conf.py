@@ -0,0 +1,18 @@
+# 生产模式：gunicorn -c gunicorn.conf.py main:app
+# 多个 worker 共用同一个 NOVELS_DIR：章节在 SQLite (WAL) 里，状态文件原子写入并加文件锁，
+# 恢复任务 / 抓取和定时检查只在拿到 .scheduler.lock 的那个 worker 里跑。
+# 正在翻译的章节记在 novel.db，预读状态在 .prefetch.json，监控计数各进程写进 .metrics/ 由 /metrics 汇总。
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_WORKERS", "2"))
+# 流式翻译 (SSE) 会一直占着一个线程，线程数决定每个 worker 能同时挂多少个读者
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "16"))
+# 非流式的 /translate_api 一章可能要好几十秒
+timeout = int(os.environ.get("WEB_TIMEOUT", "300"))
+graceful_timeout = 30
+# 每个 worker 自己导入 main (模块里会启动后台线程，不能在 master 里 preload 后 fork)
+preload_app = False
+accesslog = "-"
+errorlog = "-"
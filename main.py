@@ -3,23 +3,58 @@ import re
 import json
 import time
 import shutil
+import uuid
+import queue
+import itertools
+import collections
+import contextlib
+import atexit
+import threading
+import hashlib
+import sqlite3
+import random
+import unicodedata
+import codecs
+import zlib
+import zipfile
+import tempfile
+import posixpath
+import html
+import xml.etree.ElementTree as ET
 import requests
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for
-from bs4 import BeautifulSoup
+from urllib.parse import urljoin, urlparse, unquote, quote
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify, redirect, url_for, send_file, g
+from bs4 import BeautifulSoup, NavigableString, Tag
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.api_core import exceptions as gexc
 
-# 尝试导入 EbookLib
+# 有 lxml 就用 lxml 解析 HTML (比内置的 html.parser 快得多)
 try:
-    import ebooklib
-    from ebooklib import epub
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
 except ImportError:
-    ebooklib = None
+    HTML_PARSER = "html.parser"
+
+# 跨进程文件锁 (Linux / macOS)；没有 fcntl 的平台只能单进程运行
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 正文压缩优先用 zstd (没装就用 zlib)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 app = Flask(__name__)
 
 # ================= 配置区域 =================
 DEFAULT_GEMINI_KEY = os.environ.get("GEMINI_API_KEY", "")
-NOVELS_DIR = "/app/novels"
+NOVELS_DIR = os.environ.get("NOVELS_DIR", "/app/novels")
 if not os.path.exists(NOVELS_DIR):
     os.makedirs(NOVELS_DIR)
 
@@ -32,94 +67,2450 @@ HEADERS = {
     'Cookie': 'over18=yes; sas_view=1; sas_c=1'
 }
 
+# 文件导入：TXT 没有章节标题时每章的最大字数、每批写库的章数
+TXT_CHAPTER_MAX = int(os.environ.get("TXT_CHAPTER_MAX", "20000"))
+IMPORT_BATCH = int(os.environ.get("IMPORT_BATCH", "50"))
+
+# 整本抓取：并发数、同一站点的请求间隔 (秒)、失败重试次数
+CRAWL_WORKERS = int(os.environ.get("CRAWL_WORKERS", "4"))
+CRAWL_HOST_INTERVAL = float(os.environ.get("CRAWL_HOST_INTERVAL", "1.0"))
+CRAWL_RETRIES = int(os.environ.get("CRAWL_RETRIES", "3"))
+CRAWL_MAX_CHAPTERS = int(os.environ.get("CRAWL_MAX_CHAPTERS", "5000"))
+# 定时检查连载更新的间隔 (小时)，0 表示不自动检查
+SYNC_INTERVAL_HOURS = float(os.environ.get("SYNC_INTERVAL_HOURS", "0"))
+
+# 后台整本翻译：工作线程数 & 每个服务商同时进行的请求上限
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+PROVIDER_CONCURRENCY = {
+    "gemini": int(os.environ.get("GEMINI_CONCURRENCY", "2")),
+    "openai": int(os.environ.get("OPENAI_CONCURRENCY", "3")),
+}
+# 预读：打开 / 翻译第 N 章时在后台先翻后面几章 (阅读页可以覆盖章数，但不超过上限)；每个 Key 同时预读的章数
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", "2"))
+PREFETCH_MAX_DEPTH = int(os.environ.get("PREFETCH_MAX_DEPTH", "5"))
+PREFETCH_BUDGET = int(os.environ.get("PREFETCH_BUDGET", "1"))
+# 服务商限速 (每分钟请求数，会按 429 和响应头自动调低) 与重试
+LLM_RPM = {
+    "gemini": int(os.environ.get("GEMINI_RPM", "60")),
+    "openai": int(os.environ.get("OPENAI_RPM", "300")),
+}
+LLM_RETRIES = int(os.environ.get("LLM_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "30"))
+# 分段翻译：每段的 token 预算 & 一章之内同时翻译的段数
+SEGMENT_TOKENS = int(os.environ.get("SEGMENT_TOKENS", "1500"))
+SEGMENT_CONCURRENCY = int(os.environ.get("SEGMENT_CONCURRENCY", "3"))
+# 译文缓存：按 (原文, 服务商, 模型, 提示词版本) 复用，超过上限按最近最少使用淘汰
+CACHE_DB = os.environ.get("CACHE_DB", os.path.join(NOVELS_DIR, ".translation_cache.db"))
+CACHE_MAX_MB = int(os.environ.get("CACHE_MAX_MB", "512"))
+# 多个进程共用缓存库：每个进程至少隔这么多秒按库里的实际大小校正一次自己的计数
+CACHE_RESYNC_SECONDS = float(os.environ.get("CACHE_RESYNC_SECONDS", "10"))
+# 耗时超过这个秒数的阶段 (抓取 / 解析 / 写库 / 调用模型) 打印到日志，0 表示不打印
+SLOW_STAGE_SECONDS = float(os.environ.get("SLOW_STAGE_SECONDS", "0"))
+# 术语表：每段提示词里最多附带的术语条数 (只挑本段原文里出现过的)
+GLOSSARY_MAX_TERMS = int(os.environ.get("GLOSSARY_MAX_TERMS", "40"))
+# 全文搜索：所有小说共用的索引库、每页结果数上限、摘要的字数
+SEARCH_DB = os.environ.get("SEARCH_DB", os.path.join(NOVELS_DIR, ".search.db"))
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", "100"))
+SEARCH_SNIPPET_CHARS = int(os.environ.get("SEARCH_SNIPPET_CHARS", "80"))
+# 正文压缩：攒够多少章开始训练每本小说的压缩字典、字典大小 (zlib 最多用到 32KB)
+BODY_DICT_SAMPLES = int(os.environ.get("BODY_DICT_SAMPLES", "8"))
+BODY_DICT_BYTES = int(os.environ.get("BODY_DICT_BYTES", "65536"))
+# 阅读页：长章节按段落分页懒加载，每页大约多少字
+READER_PAGE_CHARS = int(os.environ.get("READER_PAGE_CHARS", "4000"))
+# 阅读页翻页时缓存最近读过的多少章 (解压后的全文和分页位置)
+READER_CACHE_CHAPTERS = int(os.environ.get("READER_CACHE_CHAPTERS", "32"))
+# 监控指标：各 worker 进程把自己的计数写进 METRICS_DIR 的间隔 (秒)，/metrics 汇总所有进程
+METRICS_DIR = os.path.join(NOVELS_DIR, ".metrics")
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+
+# ================= 监控指标 (/metrics，Prometheus 文本格式) =================
+_metrics = []
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _labels_text(names, values):
+    if not names: return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Counter:
+    """只增不减的计数，可以带标签"""
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self.lock: self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        with self.lock: return dict(self.values)
+
+    def render(self, values):
+        return [f"{self.name}{_labels_text(self.labels, key)} {value}" for key, value in sorted(values.items())]
+
+class Histogram:
+    """耗时分布：按桶累计次数，另记总和与总数"""
+    def __init__(self, name, help_text, labels=(), buckets=_LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, tuple(labels), buckets
+        self.values = {}  # 标签 -> [各桶次数..., 总和, 总数]
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self.lock:
+            row = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def collect(self):
+        with self.lock: return {key: list(row) for key, row in self.values.items()}
+
+    def render(self, values):
+        lines = []
+        for key, row in sorted(values.items()):
+            for bound, count in zip(self.buckets + ("+Inf",), row[:len(self.buckets)] + [row[-1]]):
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels + ('le',), key + (bound,))} {count}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {round(row[-2], 6)}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {row[-1]}")
+        return lines
+
+class Gauge:
+    """抓取时才取值的指标 (队列长度、缓存命中数等)；fn 返回数字或 {标签值元组: 数字}。
+    shared=True 表示各进程读到的是同一份数据 (共用的库)，汇总时不相加"""
+    def __init__(self, name, help_text, fn, labels=(), kind="gauge", shared=False):
+        self.name, self.help, self.fn, self.labels, self.kind, self.shared = name, help_text, fn, tuple(labels), kind, shared
+        _metrics.append(self)
+
+    def collect(self):
+        value = self.fn()
+        return dict(value) if isinstance(value, dict) else {(): value}
+
+    def render(self, values):
+        return [f"{self.name}{_labels_text(self.labels, key)} {v}" for key, v in sorted(values.items())]
+
+# ---- 多进程汇总：gunicorn 的每个 worker 都有自己的一份计数 ----
+# 每个进程定期 (以及每次被抓取时) 把计数写进 .metrics/<进程>.json，/metrics 把所有进程的加起来；
+# 进程退出后它的累计计数并进 archive.json，worker 重启不会让计数倒退，它的瞬时值 (队列长度等) 则不再算
+os.makedirs(METRICS_DIR, exist_ok=True)
+METRICS_ARCHIVE = os.path.join(METRICS_DIR, "archive.json")
+
+def _cumulative(metric):
+    return not isinstance(metric, Gauge) or metric.kind == "counter"
+
+def _merge_values(total, items):
+    """把 [[标签值列表, 数值或直方图行], ...] 累加进 {标签值元组: 数值}"""
+    for key, value in items:
+        key = tuple(key)
+        if isinstance(value, list):
+            row = total.setdefault(key, [0] * len(value))
+            for i, v in enumerate(value): row[i] += v
+        else:
+            total[key] = total.get(key, 0) + value
+
+def _process_metric_files():
+    return [os.path.join(METRICS_DIR, name) for name in os.listdir(METRICS_DIR)
+            if name.endswith('.json') and not name.startswith('.') and name != "archive.json"]
+
+def flush_metrics():
+    """把本进程的计数写进 .metrics/<进程>.json"""
+    snapshot = {metric.name: [[list(key), value] for key, value in metric.collect().items()]
+                for metric in _metrics if not getattr(metric, 'shared', False)}
+    try:
+        write_json(os.path.join(METRICS_DIR, process_id().replace(':', '-') + ".json"),
+                   {"owner": process_id(), "metrics": snapshot})
+    except OSError as e:
+        print(f"[metrics] 写入失败: {e}")
+
+def _flush_metrics_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        flush_metrics()
+
+def _archive_dead_metrics():
+    """已退出进程的累计计数并进 archive.json，删掉它们的文件"""
+    with file_lock(METRICS_ARCHIVE):
+        dead = []
+        for path in _process_metric_files():
+            data = read_json(path)
+            if data and not owner_alive(data.get('owner')): dead.append((path, data))
+        if not dead: return
+        archive = {name: {tuple(key): value for key, value in items} for name, items in read_json(METRICS_ARCHIVE, {}).items()}
+        cumulative = {metric.name for metric in _metrics if _cumulative(metric)}
+        for _, data in dead:
+            for name, items in data['metrics'].items():
+                if name in cumulative: _merge_values(archive.setdefault(name, {}), items)
+        write_json(METRICS_ARCHIVE, {name: [[list(key), value] for key, value in values.items()] for name, values in archive.items()})
+        for path, _ in dead: os.remove(path)
+
+def render_metrics():
+    """汇总所有 worker 进程的计数，输出 Prometheus 文本格式"""
+    flush_metrics()
+    _archive_dead_metrics()
+    totals = {}
+    for name, items in read_json(METRICS_ARCHIVE, {}).items(): _merge_values(totals.setdefault(name, {}), items)
+    for path in _process_metric_files():
+        for name, items in ((read_json(path) or {}).get('metrics') or {}).items():
+            _merge_values(totals.setdefault(name, {}), items)
+    lines = []
+    for metric in _metrics:
+        kind = getattr(metric, 'kind', None) or ("counter" if isinstance(metric, Counter) else "histogram")
+        values = metric.collect() if getattr(metric, 'shared', False) else totals.get(metric.name, {})
+        lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {kind}"] + metric.render(values)
+    return "\n".join(lines) + "\n"
+
+threading.Thread(target=_flush_metrics_loop, daemon=True).start()
+atexit.register(flush_metrics)
+
+REQUEST_SECONDS = Histogram("astral_http_request_duration_seconds", "HTTP 请求耗时 (流式响应只算到开始返回)", ("method", "endpoint", "status"))
+STAGE_SECONDS = Histogram("astral_stage_duration_seconds", "各处理阶段耗时", ("stage",))
+LLM_SECONDS = Histogram("astral_llm_request_duration_seconds", "调用模型的耗时 (每次尝试)", ("provider", "model", "outcome"))
+LLM_TOKENS = Counter("astral_llm_tokens_total", "模型用量 (服务商没返回用量时按字数估算)", ("provider", "model", "kind"))
+TTFT_SECONDS = Histogram("astral_stream_ttft_seconds", "流式翻译的首字耗时")
+FETCH_BYTES = Counter("astral_fetch_bytes_total", "抓取网页下载的字节数")
+CHAPTERS_IMPORTED = Counter("astral_chapters_imported_total", "写入的新章节 / 正文有变化的章节")
+CHAPTERS_TRANSLATED = Counter("astral_chapters_translated_total", "保存了完整译文的章节")
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """计时钩子：记入 astral_stage_duration_seconds，超过 SLOW_STAGE_SECONDS 时打印出来"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if SLOW_STAGE_SECONDS and elapsed >= SLOW_STAGE_SECONDS: print(f"[slow] {stage} {elapsed:.2f}s")
+
 # ================= 核心逻辑：智能抓取 & 文件处理 =================
+# 正文选择器：命中且够长就直接用 (各站点的正文容器)
+CONTENT_SELECTORS = ["#novel_honbun", ".p-novel__body", ".novel_view", ".entry-content", "#content", ".js-novel-text", "article"]
+# 行内标签：它们里面的文字算作外层块「自己」的文字
+INLINE_TAGS = {"a", "span", "ruby", "rb", "rt", "rp", "em", "strong", "b", "i", "u", "s", "font", "small", "big",
+               "sub", "sup", "br", "img", "code", "mark", "q", "cite", "abbr", "time"}
+NOISE_TAGS = ["script", "style", "noscript", "template", "iframe", "svg"]
+
 def intelligent_extract(soup):
-    """智能提取正文 (保留 V6 暴力比对算法)"""
-    candidates = []
-    selectors = ["#novel_honbun", ".novel_view", ".entry-content", "#content", ".p-novel__body", ".js-novel-text", "article"]
-    for selector in selectors:
+    """智能提取正文 (V7：一次自底向上遍历统计文字量，按段落文字量和链接密度给容器打分)"""
+    for tag in soup(NOISE_TAGS): tag.decompose()
+    for selector in CONTENT_SELECTORS:
         element = soup.select_one(selector)
         if element:
             text = element.get_text(separator="\n")
-            if len(text) > 200: candidates.append(text)
+            if len(text.strip()) > 200: return text
 
-    all_divs = soup.find_all("div")
-    if all_divs:
-        sorted_divs = sorted(all_divs, key=lambda d: len(d.get_text()), reverse=True)[:3]
-        for div in sorted_divs:
-            text = div.get_text(separator="\n")
-            if len(text) > 200: candidates.append(text)
+    root = soup.body or soup
+    text_len, link_len, score, holders = {}, {}, {}, {}
+    # find_all 是先序遍历，倒过来走就保证子节点总在父节点之前算完
+    for tag in reversed([root] + root.find_all(True)):
+        total = links = own = 0
+        for child in tag.children:
+            if isinstance(child, Tag):
+                total += text_len[id(child)]
+                links += link_len[id(child)]
+                if child.name in INLINE_TAGS: own += text_len[id(child)] - link_len[id(child)]
+            elif type(child) is NavigableString:
+                n = len(child.strip())
+                total += n
+                own += n
+        if tag.name == 'a': links = total
+        text_len[id(tag)], link_len[id(tag)] = total, links
+        if not own or tag.name in INLINE_TAGS: continue
+        # 段落 (<p> 等) 的文字记给父容器，隔一层的祖父容器记一半；直接用 <br> 排版的文字记给自己
+        holder = tag.parent if tag.name in ("p", "pre", "blockquote", "li", "dd") and tag is not root else tag
+        for node, weight in ((holder, 1), (holder.parent if holder is not root else None, 0.5)):
+            if node is None: continue
+            score[id(node)] = score.get(id(node), 0) + own * weight
+            holders[id(node)] = node
 
-    if not candidates:
-        body_text = soup.body.get_text(separator="\n") if soup.body else ""
-        return body_text if len(body_text) > 100 else None
-    return max(candidates, key=len)
+    # 最终得分再乘以 (1 - 链接密度)，压低导航栏、目录一类的容器
+    best, best_score = None, 0
+    for key, node in holders.items():
+        s = score[key] * (1 - link_len[key] / (text_len[key] or 1))
+        if s > best_score: best, best_score = node, s
 
-def save_chapter(novel_id, chapter_index, title, content):
-    """保存章节"""
+    if best is not None:
+        text = best.get_text(separator="\n")
+        if len(text.strip()) > 200: return text
+    body_text = root.get_text(separator="\n")
+    return body_text if len(body_text) > 100 else None
+
+# ---- 多进程安全：gunicorn 多个 worker 共用同一个 NOVELS_DIR ----
+# JSON 状态文件先写临时文件再 os.replace (读的一方不会看到写了一半的文件)，先读后写的地方加跨进程文件锁；
+# 后台任务 / 抓取记录是哪个进程在跑 (owner)，别的进程据此判断它是否还活着。
+@contextlib.contextmanager
+def file_lock(path):
+    """path + '.lock' 上的排他锁 (flock 按打开的文件计，同一进程的不同线程之间也互斥)"""
+    with open(path + ".lock", 'a') as f:
+        if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl: fcntl.flock(f, fcntl.LOCK_UN)
+
+def write_json(path, data):
+    """原子写入 JSON：同目录临时文件 + fsync + os.replace"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+def read_json(path, default=None):
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+    except (FileNotFoundError, NotADirectoryError):
+        return default
+
+def _process_start(pid):
+    """进程启动时刻 (/proc/<pid>/stat 第 22 项)，和 pid 一起区分重启后复用了同一 pid 的新进程"""
+    try:
+        with open(f"/proc/{pid}/stat") as f: return f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+_process_ids = {}
+
+def process_id():
+    pid = os.getpid()
+    if pid not in _process_ids: _process_ids[pid] = f"{pid}:{_process_start(pid)}"
+    return _process_ids[pid]
+
+def owner_alive(owner):
+    """记录在状态文件里的 owner 进程是否还在运行"""
+    if not owner: return False
+    if owner == process_id(): return True
+    pid = owner.split(':', 1)[0]
+    if not pid.isdigit(): return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return f"{pid}:{_process_start(int(pid))}" == owner
+
+@contextlib.contextmanager
+def write_txn(conn):
+    """BEGIN IMMEDIATE：开始时就拿到写锁，先读后写 (比如先比较哈希再写入) 的中间不会被别的进程插进来"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+# ---- 存储：每本小说一个 SQLite 文件 (WAL)，章节目录和正文分表 ----
+# 目录页只读 chapters 这张轻量索引表，正文 / 译文只在阅读、翻译时才读。
+NOVEL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    idx INTEGER PRIMARY KEY, title TEXT NOT NULL, translated INTEGER NOT NULL DEFAULT 0,
+    content_size INTEGER NOT NULL DEFAULT 0, translation_size INTEGER NOT NULL DEFAULT 0, updated_at REAL,
+    content_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS bodies (idx INTEGER PRIMARY KEY, content TEXT NOT NULL, translation TEXT NOT NULL DEFAULT '');
+CREATE TABLE IF NOT EXISTS segments (idx INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS glossary (src TEXT PRIMARY KEY, dst TEXT NOT NULL, source TEXT NOT NULL DEFAULT 'auto', updated_at REAL);
+CREATE TABLE IF NOT EXISTS dicts (id INTEGER PRIMARY KEY, algo TEXT NOT NULL, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS inflight (idx INTEGER PRIMARY KEY, owner TEXT NOT NULL, started_at REAL);
+"""
+_db_local = threading.local()
+
+def _connect(novel_id):
+    novel_dir = os.path.join(NOVELS_DIR, novel_id)
+    if not os.path.isdir(novel_dir): raise FileNotFoundError(novel_id)
+    conn = sqlite3.connect(os.path.join(novel_dir, "novel.db"), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(NOVEL_SCHEMA)
+    # 早期版本的库没有 content_hash 列
+    if 'content_hash' not in [r[1] for r in conn.execute("PRAGMA table_info(chapters)")]:
+        conn.execute("ALTER TABLE chapters ADD COLUMN content_hash TEXT")
+    return conn
+
+def novel_db(novel_id):
+    """取当前线程对这本小说的连接；第一次打开时自动迁移旧的 JSON 章节"""
+    conns = _db_local.__dict__.setdefault('conns', {})
+    conn = conns.get(novel_id)
+    if conn is None:
+        conn = conns[novel_id] = _connect(novel_id)
+        migrate_json_chapters(novel_id, conn)
+    return conn
+
+def novel_exists(novel_id):
+    return os.path.exists(os.path.join(NOVELS_DIR, novel_id, "meta.json"))
+
+def migrate_json_chapters(novel_id, conn=None):
+    """把旧版 chapters/{index}.json 一次性导入 novel.db，导入成功后删除旧目录"""
     chapter_dir = os.path.join(NOVELS_DIR, novel_id, "chapters")
-    if not os.path.exists(chapter_dir): os.makedirs(chapter_dir)
-    
-    data = {"index": chapter_index, "title": title, "content": content, "translation": ""}
-    file_path = os.path.join(chapter_dir, f"{chapter_index}.json")
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            old_data = json.load(f)
-            if old_data.get('translation'): data['translation'] = old_data['translation']
+    if not os.path.isdir(chapter_dir): return 0
+    with file_lock(os.path.join(NOVELS_DIR, novel_id, "migrate")):
+        if not os.path.isdir(chapter_dir): return 0
+        conn = conn or _connect(novel_id)
+        codec = body_codec(novel_id, conn)
+        files = [f for f in os.listdir(chapter_dir) if f.endswith('.json')]
+        with conn:
+            for name in files:
+                with open(os.path.join(chapter_dir, name), 'r', encoding='utf-8') as f: d = json.load(f)
+                _write_chapter(conn, codec, int(d['index']), d['title'], d['content'], d.get('translation', ''))
+                if d.get('segments'):
+                    conn.execute("INSERT OR REPLACE INTO segments VALUES (?, ?)",
+                                 (int(d['index']), codec.encode(json.dumps(d['segments'], ensure_ascii=False))))
+        shutil.rmtree(chapter_dir, ignore_errors=True)
+        return len(files)
+
+def migrate_all():
+    """迁移书架上所有还是 JSON 章节的小说"""
+    total = 0
+    for name in os.listdir(NOVELS_DIR):
+        if novel_exists(name): total += migrate_json_chapters(name)
+    return total
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+# ---- 正文压缩：bodies / segments 存压缩后的 BLOB，同一本小说共用一个压缩字典 ----
+# 同一本书各章之间重复很多 (人名、口癖、前書き / 後書き)，用最早的几章训练一个字典，之后每章都带着字典压缩，
+# 短章节也能压得很小。装了 zstandard 就用 zstd，否则用 zlib (字典就是预置在窗口里的一段文本)。
+# BLOB 头部：1 字节算法 (S = zstd，Z = zlib) + 4 字节字典编号 (0 = 不带字典)；旧数据里的 TEXT 原样读出。
+ZSTD_LEVEL = 6
+
+def dictionary_text(samples, limit):
+    """给 zlib 用的字典：多章都出现的行 (越常见越靠后，离窗口末尾越近编码越短)，不够再用样本正文补齐"""
+    counts = {}
+    for text in samples:
+        for line in {line.strip() for line in text.split("\n")}:
+            if line: counts[line] = counts.get(line, 0) + 1
+    common = "\n".join(line for line, n in sorted(counts.items(), key=lambda kv: kv[1]) if n >= 2)
+    data = ("\n".join(samples) + "\n" + common).encode('utf-8')
+    return data[-limit:]
+
+def build_dictionary(samples):
+    """返回 (算法, 字典字节)；zstd 样本太少训练不出来时也退回原文字典"""
+    raw = [text.encode('utf-8') for text in samples if text]
+    if zstandard:
+        try:
+            return 'zstd', zstandard.train_dictionary(BODY_DICT_BYTES, raw, level=ZSTD_LEVEL).as_bytes()
+        except zstandard.ZstdError:
+            return 'zstd', dictionary_text(samples, BODY_DICT_BYTES)
+    return 'zlib', dictionary_text(samples, 32768)
+
+class BodyCodec:
+    """一本小说的压缩 / 解压；字典建好以后不再改动，按编号缓存"""
+    def __init__(self, novel_id):
+        self.novel_id = novel_id
+        self.dicts = {}
+        self.zstd_dicts = {}
+        self.current = 0
+        self.lock = threading.Lock()
+
+    def load(self, conn):
+        with self.lock:
+            for dict_id, algo, data in conn.execute("SELECT id, algo, data FROM dicts"):
+                self.dicts[dict_id] = (algo, bytes(data))
+            # 字典是 zstd 的但本进程没装 zstandard：新写入的章节先不带字典
+            usable = [dict_id for dict_id, (algo, _) in self.dicts.items() if algo == 'zlib' or zstandard]
+            self.current = max(usable, default=0)
+
+    def _zstd_dict(self, dict_id):
+        # 预先算好压缩用的内部结构，之后多个线程可以同时拿它压缩
+        with self.lock:
+            if dict_id not in self.zstd_dicts:
+                zdict = zstandard.ZstdCompressionDict(self.dicts[dict_id][1])
+                zdict.precompute_compress(level=ZSTD_LEVEL)
+                self.zstd_dicts[dict_id] = zdict
+            return self.zstd_dicts[dict_id]
+
+    def encode(self, text):
+        """压缩成 BLOB；空串原样保存"""
+        if not text: return ""
+        raw = text.encode('utf-8')
+        dict_id = self.current
+        algo, data = self.dicts[dict_id] if dict_id else ('zstd' if zstandard else 'zlib', None)
+        if algo == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self._zstd_dict(dict_id) if dict_id else None)
+            body = b'S' + compressor.compress(raw)
+        else:
+            compressor = zlib.compressobj(6, zdict=data) if data else zlib.compressobj(6)
+            body = b'Z' + compressor.compress(raw) + compressor.flush()
+        return body[:1] + dict_id.to_bytes(4, 'big') + body[1:]
+
+    def decode(self, conn, value):
+        """解压；TEXT (压缩之前存的) 和 None 原样返回"""
+        if value is None or isinstance(value, str): return value or ""
+        value = bytes(value)
+        dict_id = int.from_bytes(value[1:5], 'big')
+        # 别的进程刚建的字典
+        if dict_id and dict_id not in self.dicts: self.load(conn)
+        payload = value[5:]
+        if value[:1] == b'S':
+            if zstandard is None: raise RuntimeError("这本小说的正文用 zstd 压缩，需要安装 zstandard")
+            decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dict(dict_id) if dict_id else None)
+            return decompressor.decompress(payload).decode('utf-8')
+        decompressor = zlib.decompressobj(zdict=self.dicts[dict_id][1]) if dict_id else zlib.decompressobj()
+        return (decompressor.decompress(payload) + decompressor.flush()).decode('utf-8')
 
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    def train(self, conn, new_texts=()):
+        """还没有字典、已存的章节加上这次要写的凑够 BODY_DICT_SAMPLES 章时建字典，并用它重新压缩已存的样本章节"""
+        if self.dicts: return False
+        rows = conn.execute("SELECT idx, content, translation FROM bodies ORDER BY idx LIMIT ?", (BODY_DICT_SAMPLES * 2,)).fetchall()
+        stored = [(idx, self.decode(conn, content), self.decode(conn, translation)) for idx, content, translation in rows]
+        samples = [content for _, content, _ in stored] + [text for text in new_texts if text]
+        if len(samples) < BODY_DICT_SAMPLES: return False
+        algo, data = build_dictionary(samples[:BODY_DICT_SAMPLES * 2])
+        with write_txn(conn):
+            # 多个进程同时建字典时只留第一个
+            if conn.execute("SELECT 1 FROM dicts").fetchone() is None:
+                conn.execute("INSERT INTO dicts (id, algo, data) VALUES (1, ?, ?)", (algo, data))
+        self.load(conn)
+        ids = [idx for idx, _, _ in stored]
+        with write_txn(conn):
+            # 上面的样本是在事务外读的，这期间可能刚有译文写进来：在事务里重新读一遍再压缩，不拿旧值覆盖
+            for idx, content, translation in conn.execute(f"SELECT idx, content, translation FROM bodies WHERE idx IN ({','.join('?' * len(ids))})", ids).fetchall():
+                conn.execute("UPDATE bodies SET content = ?, translation = ? WHERE idx = ?",
+                             (self.encode(self.decode(conn, content)), self.encode(self.decode(conn, translation)), idx))
+        return True
 
-def create_novel_meta(novel_name, source_type):
+    def recompress(self, conn):
+        """把没带当前字典的正文 / 分段 (包括压缩之前存的 TEXT) 全部重新压缩，返回处理的行数"""
+        prefix = None
+        if self.current:
+            prefix = (b'S' if self.dicts[self.current][0] == 'zstd' else b'Z') + self.current.to_bytes(4, 'big')
+        total = 0
+        for table, columns in (("bodies", ("content", "translation")), ("segments", ("data",))):
+            ids = [r[0] for r in conn.execute(f"SELECT idx FROM {table} ORDER BY idx")]
+            for i in range(0, len(ids), IMPORT_BATCH):
+                with write_txn(conn):
+                    for row in conn.execute(f"SELECT idx, {', '.join(columns)} FROM {table} WHERE idx IN ({','.join('?' * len(ids[i:i + IMPORT_BATCH]))})",
+                                            ids[i:i + IMPORT_BATCH]).fetchall():
+                        if all(not value or (isinstance(value, bytes) and value[:5] == prefix) for value in row[1:]): continue
+                        values = [self.encode(self.decode(conn, value)) for value in row[1:]]
+                        conn.execute(f"UPDATE {table} SET {', '.join(c + ' = ?' for c in columns)} WHERE idx = ?", (*values, row[0]))
+                        total += 1
+        return total
+
+_codecs = {}
+_codecs_lock = threading.Lock()
+
+def body_codec(novel_id, conn):
+    """这本小说的压缩器 (整个进程共用一个)，第一次用时从 conn 读字典"""
+    with _codecs_lock:
+        codec = _codecs.get(novel_id)
+        if codec is None:
+            codec = _codecs[novel_id] = BodyCodec(novel_id)
+            codec.load(conn)
+    return codec
+
+def compress_all():
+    """python main.py compress：给每本小说建字典，把所有章节重新压缩，再 VACUUM 回收空间"""
+    total = 0
+    for name in os.listdir(NOVELS_DIR):
+        if not novel_exists(name): continue
+        conn = novel_db(name)
+        codec = body_codec(name, conn)
+        codec.train(conn)
+        total += codec.recompress(conn)
+        conn.execute("VACUUM")
+    return total
+
+def _write_chapter(conn, codec, chapter_index, title, content, translation=None):
+    """写入章节；translation 为 None 时保留已有译文"""
+    now = time.time()
+    if translation is None:
+        conn.execute("""INSERT INTO chapters (idx, title, content_size, updated_at, content_hash) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(idx) DO UPDATE SET title = excluded.title, content_size = excluded.content_size,
+                        updated_at = excluded.updated_at, content_hash = excluded.content_hash""",
+                     (chapter_index, title, len(content), now, content_hash(content)))
+        conn.execute("""INSERT INTO bodies (idx, content) VALUES (?, ?)
+                        ON CONFLICT(idx) DO UPDATE SET content = excluded.content""", (chapter_index, codec.encode(content)))
+    else:
+        conn.execute("""INSERT OR REPLACE INTO chapters (idx, title, translated, content_size, translation_size, updated_at, content_hash)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                     (chapter_index, title, int(bool(translation)), len(content), len(translation), now, content_hash(content)))
+        conn.execute("INSERT OR REPLACE INTO bodies VALUES (?, ?, ?)", (chapter_index, codec.encode(content), codec.encode(translation)))
+
+def _save_chapter(conn, codec, chapter_index, title, content):
+    row = conn.execute("""SELECT c.content_hash, b.content, c.title FROM chapters c JOIN bodies b ON b.idx = c.idx
+                          WHERE c.idx = ?""", (int(chapter_index),)).fetchone()
+    new_hash = content_hash(content)
+    changed = row is None or (row[0] or content_hash(codec.decode(conn, row[1]))) != new_hash
+    if not changed:
+        # 正文没变 (同步 / 抓取又下载了一遍)：不重写，updated_at 不动，导出缓存和阅读页缓存都还有效
+        if row[0] is None: conn.execute("UPDATE chapters SET content_hash = ? WHERE idx = ?", (new_hash, int(chapter_index)))
+        if row[2] != title: conn.execute("UPDATE chapters SET title = ?, updated_at = ? WHERE idx = ?", (title, time.time(), int(chapter_index)))
+        return False
+    _write_chapter(conn, codec, int(chapter_index), title, content, "" if row is not None else None)
+    return True
+
+def save_chapter(novel_id, chapter_index, title, content):
+    """保存章节，返回正文是否有变化。
+    正文没变时保留已有译文；变了就清空译文 (分段译文保留，没改动的段落重翻时直接复用)。"""
+    conn = novel_db(novel_id)
+    codec = body_codec(novel_id, conn)
+    codec.train(conn, [content])
+    with stage_timer('save_chapter'), write_txn(conn): changed = _save_chapter(conn, codec, chapter_index, title, content)
+    if changed:
+        CHAPTERS_IMPORTED.inc()
+        search_index.safe_update(novel_id, [chapter_index])
+    return changed
+
+def save_chapters(novel_id, chapters):
+    """批量保存 [(index, title, content)]，一个事务提交"""
+    conn = novel_db(novel_id)
+    codec = body_codec(novel_id, conn)
+    codec.train(conn, [content for _, _, content in chapters])
+    with stage_timer('save_chapter'), write_txn(conn):
+        changed = [chapter_index for chapter_index, title, content in chapters if _save_chapter(conn, codec, chapter_index, title, content)]
+    CHAPTERS_IMPORTED.inc(len(changed))
+    search_index.safe_update(novel_id, changed)
+
+def load_chapter(novel_id, chapter_index):
+    """读取章节全文，不存在返回 None"""
+    if not novel_exists(novel_id): return None
+    conn = novel_db(novel_id)
+    row = conn.execute("""SELECT c.title, b.content, b.translation, s.data FROM chapters c JOIN bodies b ON b.idx = c.idx
+                          LEFT JOIN segments s ON s.idx = c.idx WHERE c.idx = ?""", (int(chapter_index),)).fetchone()
+    if row is None: return None
+    codec = body_codec(novel_id, conn)
+    segments = codec.decode(conn, row[3])
+    return {"index": int(chapter_index), "title": row[0], "content": codec.decode(conn, row[1]),
+            "translation": codec.decode(conn, row[2]), "segments": json.loads(segments) if segments else []}
+
+def save_translation(novel_id, chapter_index, trans_text, segments=None):
+    """只更新章节的译文 (以及分段译文)；trans_text 为 None 时只保存分段进度，已有的整章译文不动"""
+    conn = novel_db(novel_id)
+    codec = body_codec(novel_id, conn)
+    with conn:
+        if trans_text is not None:
+            conn.execute("UPDATE bodies SET translation = ? WHERE idx = ?", (codec.encode(trans_text), int(chapter_index)))
+            conn.execute("UPDATE chapters SET translated = ?, translation_size = ?, updated_at = ? WHERE idx = ?",
+                         (int(bool(trans_text)), len(trans_text), time.time(), int(chapter_index)))
+        if segments is not None:
+            conn.execute("INSERT OR REPLACE INTO segments VALUES (?, ?)", (int(chapter_index), codec.encode(json.dumps(segments, ensure_ascii=False))))
+    if trans_text is None: return
+    if trans_text: CHAPTERS_TRANSLATED.inc()
+    search_index.safe_update(novel_id, [chapter_index])
+
+def page_bounds(text, size=READER_PAGE_CHARS):
+    """按段落分页：每页凑够 size 字后在下一个换行处断开，返回每页的 (起, 止)"""
+    bounds, start = [], 0
+    while start < len(text):
+        end = text.find("\n", start + size)
+        end = len(text) if end < 0 else end + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+def text_page(text, page, bounds=None):
+    """第 page 页的文字和总页数；超出范围返回空串"""
+    if bounds is None: bounds = page_bounds(text)
+    if page >= len(bounds): return "", len(bounds)
+    start, end = bounds[page]
+    return text[start:end], len(bounds)
+
+_reader_pages = collections.OrderedDict()  # (novel_id, idx, part, updated_at) -> (全文, 分页)
+_reader_pages_lock = threading.Lock()
+
+def chapter_pages(novel_id, chapter_index, part):
+    """阅读页翻页用：这一章原文 / 译文的全文和分页，不存在返回 None。
+    按 updated_at 缓存最近读过的几章，往下翻页不用每次都解压整章、重新分页；章节改过以后自然换一份"""
+    if not novel_exists(novel_id): return None
+    row = novel_db(novel_id).execute("SELECT updated_at FROM chapters WHERE idx = ?", (int(chapter_index),)).fetchone()
+    if row is None: return None
+    key = (novel_id, int(chapter_index), part, row[0])
+    with _reader_pages_lock:
+        if key in _reader_pages:
+            _reader_pages.move_to_end(key)
+            return _reader_pages[key]
+    data = load_chapter(novel_id, chapter_index)
+    if data is None: return None
+    entry = (data[part], page_bounds(data[part]))
+    with _reader_pages_lock:
+        _reader_pages[key] = entry
+        while len(_reader_pages) > READER_CACHE_CHAPTERS: _reader_pages.popitem(last=False)
+    return entry
+
+def list_chapters(novel_id):
+    """章节目录 (不读正文)"""
+    rows = novel_db(novel_id).execute("SELECT idx, title, translated, content_size, translation_size FROM chapters ORDER BY idx")
+    return [{"index": r[0], "title": r[1], "has_trans": bool(r[2]), "content_size": r[3], "translation_size": r[4]} for r in rows]
+
+def chapter_exists(novel_id, chapter_index):
+    return novel_db(novel_id).execute("SELECT 1 FROM chapters WHERE idx = ?", (int(chapter_index),)).fetchone() is not None
+
+def create_novel_meta(novel_name, source_type, source_url=None):
     """创建元数据"""
     novel_id = re.sub(r'[^\w\-_]', '', novel_name)[:50] 
     if not novel_id: novel_id = "novel_" + str(int(time.time()))
     novel_dir = os.path.join(NOVELS_DIR, novel_id)
-    if not os.path.exists(novel_dir): os.makedirs(novel_dir)
+    os.makedirs(novel_dir, exist_ok=True)
     meta = {"title": novel_name, "type": source_type, "created_at": time.time()}
-    with open(os.path.join(novel_dir, "meta.json"), 'w', encoding='utf-8') as f:
-        json.dump(meta, f, ensure_ascii=False)
+    if source_url: meta['source_url'] = source_url
+    write_json(os.path.join(novel_dir, "meta.json"), meta)
+    novel_db(novel_id)
     return novel_id
 
+def novel_revision(novel_id):
+    """章节内容 / 译文的指纹：任何一章有改动 (updated_at 都会刷新) 就会变，用来判断导出缓存是否过期"""
+    row = novel_db(novel_id).execute("SELECT COUNT(*), MAX(updated_at), SUM(updated_at) FROM chapters").fetchone()
+    return hashlib.sha1(repr(row).encode('utf-8')).hexdigest()[:12]
+
+def load_meta(novel_id):
+    with open(os.path.join(NOVELS_DIR, novel_id, "meta.json"), 'r', encoding='utf-8') as f: return json.load(f)
+
 def process_url_import(url):
     """处理 URL 导入"""
-    resp = requests.get(url, headers=HEADERS, timeout=15)
-    resp.encoding = resp.apparent_encoding
-    soup = BeautifulSoup(resp.text, 'html.parser')
+    resp = fetch_page(url)
+    with stage_timer('parse'): soup = BeautifulSoup(resp.text, HTML_PARSER)
     title = soup.find('title').text.strip() if soup.find('title') else "网页抓取_" + str(int(time.time()))
-    content = intelligent_extract(soup)
+    with stage_timer('extract'): content = intelligent_extract(soup)
     if not content: raise Exception("无法提取网页正文")
-    novel_id = create_novel_meta(title, "web")
+    novel_id = create_novel_meta(title, "web", source_url=url)
     save_chapter(novel_id, 1, title, content)
     return novel_id
 
-def process_txt(file_path, novel_name):
-    """处理 TXT"""
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f: text = f.read()
-    novel_id = create_novel_meta(novel_name, "txt")
-    chunk_size = 3000
-    chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
-    for i, chunk in enumerate(chunks):
-        save_chapter(novel_id, i+1, f"第 {i+1} 部分", chunk)
-    return novel_id
+# ---- 文件导入：边读边切章，分批写库，不把整本书读进内存 ----
+CHAPTER_HEADING_RE = re.compile(
+    r'^\s*(第\s*[0-9０-９零〇一二两三四五六七八九十百千万]+\s*[章节節回话話卷部集幕篇]|[#＃]+\s*\S|'
+    r'(序章|序幕|楔子|终章|終章|尾声|番外[篇編]?|プロローグ|エピローグ|あとがき|Chapter\s+\d+)(?=\s|$|[:：.．、]))', re.I)
+
+def detect_encoding(file_path):
+    """根据文件开头 64KB 猜编码：BOM > UTF-8 > charset_normalizer (如果装了) > 常见中日文编码"""
+    with open(file_path, 'rb') as f: head = f.read(65536)
+    if head.startswith(codecs.BOM_UTF8): return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)): return 'utf-16'
+    candidates = ['utf-8']
+    try:
+        from charset_normalizer import from_bytes
+        best = from_bytes(head).best()
+        if best: candidates.append(best.encoding)
+    except ImportError:
+        pass
+    for encoding in candidates + ['gb18030', 'shift_jis', 'big5']:
+        try:
+            # 结尾可能截断在多字节字符中间，用增量解码器且不 final
+            codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return 'utf-8'
+
+LINE_BREAK_RE = re.compile(r'\r\n|\r|\n')
+
+def _cut_line(line):
+    """超过 TXT_CHAPTER_MAX 的行 (整个文件没有换行时) 按长度硬切"""
+    while len(line) > TXT_CHAPTER_MAX:
+        yield line[:TXT_CHAPTER_MAX]
+        line = line[TXT_CHAPTER_MAX:]
+    yield line
 
-def process_epub(file_path, novel_name):
-    """处理 EPUB"""
-    if not ebooklib: return None
-    book = epub.read_epub(file_path)
-    novel_id = create_novel_meta(novel_name, "epub")
-    index = 1
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            soup = BeautifulSoup(item.get_content(), 'html.parser')
+def iter_txt_lines(file_path, encoding, progress):
+    """按 1MB 块读取并增量解码，逐行 yield (\r\n、\r、\n 都算换行，超长的行硬切)；progress['done'] 记录已读字节数"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ""
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            pending += decoder.decode(chunk, final=not chunk)
+            # 块末尾的 \r 可能和下一块开头的 \n 是同一个换行，先留着
+            tail = "\r" if chunk and pending.endswith("\r") else ""
+            lines = LINE_BREAK_RE.split(pending[:len(pending) - len(tail)])
+            pending = lines.pop() + tail
+            for line in lines: yield from _cut_line(line)
+            # 没有换行的文件：攒着的半行也不能无限变长
+            if len(pending) > TXT_CHAPTER_MAX:
+                *pieces, pending = _cut_line(pending)
+                yield from pieces
+            progress['done'] = f.tell()
+            if not chunk: break
+    if pending: yield from _cut_line(pending)
+
+def iter_txt_chapters(file_path, progress):
+    """按章节标题 (第X章、＃ 等) 切章；没有标题或一章太长时按 TXT_CHAPTER_MAX 在行尾切开"""
+    progress['total'] = os.path.getsize(file_path)
+    title, lines, size, part = None, [], 0, 1
+
+    def chapter():
+        text = "\n".join(lines).strip("\n")
+        if title is None: name = f"第 {part} 部分"
+        else: name = title if part == 1 else f"{title} ({part})"
+        return name, text
+
+    for line in iter_txt_lines(file_path, detect_encoding(file_path), progress):
+        stripped = line.strip()
+        if len(stripped) < 50 and CHAPTER_HEADING_RE.match(stripped):
+            if "".join(lines).strip(): yield chapter()
+            title, lines, size, part = stripped, [], 0, 1
+            continue
+        # 加上这一行就超长：先把已有的切成一章
+        if lines and size + len(line) > TXT_CHAPTER_MAX:
+            yield chapter()
+            lines, size, part = [], 0, part + 1
+        lines.append(line)
+        size += len(line) + 1
+        if size >= TXT_CHAPTER_MAX:
+            yield chapter()
+            lines, size, part = [], 0, part + 1
+    if "".join(lines).strip(): yield chapter()
+
+def iter_epub_chapters(file_path, progress):
+    """按书脊 (spine) 顺序一章一章地从 zip 里读 XHTML，不像 ebooklib 那样一次载入整本"""
+    with zipfile.ZipFile(file_path) as zf:
+        container = ET.fromstring(zf.read("META-INF/container.xml"))
+        opf_path = container.find(".//{*}rootfile").get("full-path")
+        opf = ET.fromstring(zf.read(opf_path))
+        base = posixpath.dirname(opf_path)
+        manifest = {item.get("id"): item.get("href") for item in opf.iterfind(".//{*}manifest/{*}item")}
+        spine = [ref.get("idref") for ref in opf.iterfind(".//{*}spine/{*}itemref")]
+        progress['total'] = len(spine)
+        for n, idref in enumerate(spine, 1):
+            href = manifest.get(idref)
+            progress['done'] = n
+            if not href: continue
+            soup = BeautifulSoup(zf.read(posixpath.normpath(posixpath.join(base, unquote(href)))), HTML_PARSER)
             text = soup.get_text(separator="\n").strip()
             if len(text) > 100:
                 title_tag = soup.find(['h1', 'h2', 'h3'])
-                title = title_tag.text.strip() if title_tag else f"章节 {index}"
-                save_chapter(novel_id, index, title, text)
-                index += 1
+                yield (title_tag.text.strip() if title_tag else None), text
+
+def import_path(novel_id):
+    return os.path.join(NOVELS_DIR, novel_id, "import.json")
+
+def import_file(novel_id, file_path, ext, progress):
+    """导入上传的文件，每 IMPORT_BATCH 章写一次库 (同时把进度写进 import.json，别的进程也能查)；结束后删除临时文件"""
+    progress.update({"status": "running", "chapters": 0, "done": 0, "total": 0, "error": None, "owner": process_id()})
+    try:
+        chapters = iter_txt_chapters(file_path, progress) if ext == '.txt' else iter_epub_chapters(file_path, progress)
+        batch = []
+        for title, text in chapters:
+            index = progress['chapters'] + len(batch) + 1
+            batch.append((index, title or f"章节 {index}", text))
+            if len(batch) >= IMPORT_BATCH:
+                save_chapters(novel_id, batch)
+                progress['chapters'] += len(batch)
+                batch = []
+                write_json(import_path(novel_id), progress)
+        save_chapters(novel_id, batch)
+        progress['chapters'] += len(batch)
+        progress['status'] = 'done'
+    except Exception as e:
+        progress.update({"status": "failed", "error": str(e)})
+    finally:
+        write_json(import_path(novel_id), progress)
+        if os.path.exists(file_path): os.remove(file_path)
+
+def import_status(novel_id):
+    """导入进度：本进程在导入就读内存，否则读 import.json；导入它的进程已经不在了就算失败"""
+    state = import_states.get(novel_id)
+    if state: return state
+    state = read_json(import_path(novel_id))
+    if state and state.get('status') in ('queued', 'running') and not owner_alive(state.get('owner')):
+        state.update({"status": "failed", "error": "服务重启，导入中断，请重新上传"})
+    return state
+
+# 后台导入的进度 (只在内存里，重启后临时文件也没了，不做恢复)
+import_states = {}
+
+def start_import(file_path, novel_name, ext):
+    novel_id = create_novel_meta(novel_name, ext.lstrip('.'))
+    import_states[novel_id] = {"status": "queued", "owner": process_id()}
+    write_json(import_path(novel_id), import_states[novel_id])
+    threading.Thread(target=import_file, args=(novel_id, file_path, ext, import_states[novel_id]), daemon=True).start()
+    return novel_id
+
+# ================= 整本抓取：目录页 → 并发下载所有章节 =================
+# 进度保存在 meta.json 旁边的 crawl.json，重启后自动继续。
+http_session = requests.Session()
+http_session.headers.update(HEADERS)
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(CRAWL_WORKERS * 2, 10))
+http_session.mount('http://', _adapter)
+http_session.mount('https://', _adapter)
+
+class HostRateLimiter:
+    """同一站点两次请求之间至少间隔 interval 秒"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_at = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            at = max(now, self.next_at.get(host, 0))
+            self.next_at[host] = at + self.interval
+        if at > now: time.sleep(at - now)
+
+host_limiter = HostRateLimiter(CRAWL_HOST_INTERVAL)
+
+def fetch_page(url, etag=None, last_modified=None):
+    """带限速、重试 (429/5xx/网络错误，指数退避) 和条件请求的 GET；未修改时返回 status 304 的响应"""
+    headers = {}
+    if etag: headers['If-None-Match'] = etag
+    if last_modified: headers['If-Modified-Since'] = last_modified
+    for attempt in range(CRAWL_RETRIES + 1):
+        host_limiter.wait(url)
+        try:
+            with stage_timer('fetch'): resp = http_session.get(url, headers=headers, timeout=15)
+        except requests.RequestException:
+            if attempt == CRAWL_RETRIES: raise
+            time.sleep(2 ** attempt)
+            continue
+        if resp.status_code == 429 or resp.status_code >= 500:
+            if attempt == CRAWL_RETRIES: resp.raise_for_status()
+            retry_after = resp.headers.get('Retry-After', '')
+            time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+            continue
+        if resp.status_code != 304:
+            resp.raise_for_status()
+            FETCH_BYTES.inc(len(resp.content))
+            resp.encoding = resp.apparent_encoding
+        return resp
+
+def page_title(soup):
+    tag = soup.select_one(".p-novel__title, .novel_subtitle, .novel_title, h1") or soup.find('title')
+    return tag.get_text().strip() if tag else ""
+
+def _toc_updated(a):
+    """syosetu 目录里每话的发布 / 改稿时间，检查更新时用来跳过没改过的章节"""
+    box = a.find_parent(class_=["p-eplist__sublist", "novel_sublist2"])
+    tag = box.select_one(".p-eplist__update, .long_update") if box else None
+    if not tag: return None
+    revised = tag.find('span', title=True)
+    return tag.get_text(" ", strip=True) + (" " + revised['title'] if revised else "")
+
+def discover_chapters(index_url, soup):
+    """从目录页找出所有章节链接 (按页面顺序)；syosetu 的分页目录会继续翻页"""
+    links, seen, page_url, pages = [], set(), index_url, 0
+    base_path = urlparse(index_url).path.rstrip('/') + '/'
+    index_host = urlparse(index_url).netloc
+
+    def looks_like_chapter(url):
+        # 通用规则：同站、路径在目录页下面、最后一级是数字 (/n1234ab/1/、/book/12.html)
+        parsed = urlparse(url)
+        return (parsed.netloc == index_host and parsed.path.startswith(base_path)
+                and re.fullmatch(r'\d+(\.html?)?/?', parsed.path[len(base_path):]) is not None)
+
+    while soup is not None and pages < 100:
+        pages += 1
+        anchors = soup.select("a.p-eplist__subtitle, .novel_sublist2 a, dd.subtitle a")
+        if not anchors:
+            anchors = [a for a in soup.find_all('a', href=True) if looks_like_chapter(urljoin(page_url, a['href']))]
+        for a in anchors:
+            url = urljoin(page_url, a.get('href', ''))
+            if url not in seen:
+                seen.add(url)
+                link = {"url": url, "title": a.get_text().strip()}
+                updated = _toc_updated(a)
+                if updated: link['updated'] = updated
+                links.append(link)
+        pager = soup.select_one("a.c-pager__item--next")
+        if not pager: break
+        page_url = urljoin(page_url, pager['href'])
+        soup = BeautifulSoup(fetch_page(page_url).text, HTML_PARSER)
+    return links
+
+def crawl_path(novel_id):
+    return os.path.join(NOVELS_DIR, novel_id, "crawl.json")
+
+crawl_states = {}
+crawl_lock = threading.Lock()
+Gauge("astral_crawls_running", "正在抓取的小说数", lambda: sum(1 for st in list(crawl_states.values()) if st.get('status') == 'running'))
+
+def persist_crawl(novel_id, force=False):
+    """写回 crawl.json；抓取过程中最多每秒写一次"""
+    with crawl_lock:
+        state = crawl_states[novel_id]
+        if not force and time.time() - state.get('_saved_at', 0) < 1: return
+        state['_saved_at'] = state['updated_at'] = time.time()
+        state['owner'] = process_id()
+        write_json(crawl_path(novel_id), {k: v for k, v in state.items() if not k.startswith('_')})
+
+def crawl_state(novel_id):
+    """抓取状态：本进程正在抓就用内存里的，否则读 crawl.json 里最新的 (可能是别的进程在抓)"""
+    with crawl_lock:
+        state = crawl_states.get(novel_id)
+        if state and state.get('_thread') and state['_thread'].is_alive(): return state
+    saved = read_json(crawl_path(novel_id))
+    if saved is None: return state
+    with crawl_lock:
+        crawl_states[novel_id] = saved
+        return saved
+
+def crawl_running_elsewhere(state):
+    return state['status'] == 'running' and state.get('owner') != process_id() and owner_alive(state.get('owner'))
+
+def crawl_progress(state):
+    done = sum(1 for ch in state['chapters'] if ch['status'] == 'done')
+    failed = sum(1 for ch in state['chapters'] if ch['status'] == 'failed')
+    return {"url": state['url'], "status": state['status'], "total": len(state['chapters']), "done": done, "failed": failed,
+            "changed": state.get('changed', 0)}
+
+def find_next_link(page_url, soup):
+    """没有目录页时，顺着正文页的「下一话」链接走"""
+    a = soup.find('a', rel='next', href=True)
+    if not a:
+        a = soup.find('a', href=True, string=re.compile(r'^\s*(次へ|次の話|次話|下一章|下一页|下一頁|Next)', re.I))
+    return urljoin(page_url, a['href']) if a else None
+
+def _crawl_chapter(novel_id, index, chapter, follow_next=False):
+    """下载并保存一章，返回要写回 crawl.json 的字段；304 时不重新保存"""
+    resp = fetch_page(chapter['url'], chapter.get('etag'), chapter.get('last_modified'))
+    if resp.status_code == 304: return {"status": "done"}
+    with stage_timer('parse'): soup = BeautifulSoup(resp.text, HTML_PARSER)
+    with stage_timer('extract'): content = intelligent_extract(soup)
+    if not content: raise Exception("无法提取网页正文")
+    changed = save_chapter(novel_id, index, chapter.get('title') or page_title(soup) or f"第 {index} 话", content)
+    update = {"status": "done", "etag": resp.headers.get('ETag'), "last_modified": resp.headers.get('Last-Modified'), "changed": changed}
+    if follow_next: update['next'] = find_next_link(chapter['url'], soup)
+    return update
+
+def run_crawl(novel_id):
+    """并发下载 crawl.json 里还没完成的章节；「下一话」模式下边下边发现新章节"""
+    state = crawl_states[novel_id]
+    follow_next = state.get('follow_next', False)
+    while True:
+        todo = [(i + 1, ch) for i, ch in enumerate(state['chapters']) if ch['status'] == 'pending']
+        if not todo or len(state['chapters']) > CRAWL_MAX_CHAPTERS: break
+        with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as pool:
+            futures = {pool.submit(_crawl_chapter, novel_id, index, dict(ch), follow_next): ch for index, ch in todo}
+            for fut in as_completed(futures):
+                try:
+                    update = fut.result()
+                except Exception as e:
+                    update = {"status": "failed", "error": str(e)}
+                next_url = update.pop('next', None)
+                with crawl_lock:
+                    if update.pop('changed', False): state['changed'] = state.get('changed', 0) + 1
+                    futures[fut].pop('error', None)
+                    futures[fut].update(update)
+                    if next_url and next_url not in {ch['url'] for ch in state['chapters']}:
+                        state['chapters'].append({"url": next_url, "title": "", "status": "pending"})
+                persist_crawl(novel_id)
+    with crawl_lock:
+        state['status'] = 'failed' if any(ch['status'] == 'failed' for ch in state['chapters']) else 'done'
+    persist_crawl(novel_id, force=True)
+
+def start_crawl(novel_id):
+    with crawl_lock:
+        state = crawl_states[novel_id]
+        if state.get('_thread') and state['_thread'].is_alive(): return
+        if crawl_running_elsewhere(state): return
+        state['status'] = 'running'
+        for ch in state['chapters']:
+            if ch['status'] != 'done': ch['status'] = 'pending'
+        state['_thread'] = threading.Thread(target=run_crawl, args=(novel_id,), daemon=True)
+        state['_thread'].start()
+
+def process_url_crawl(url):
+    """整本导入：解析目录页，建书后在后台下载全部章节；没有目录时顺着「下一话」链接抓，都没有就退回单章导入"""
+    resp = fetch_page(url)
+    soup = BeautifulSoup(resp.text, HTML_PARSER)
+    chapters = discover_chapters(url, soup)
+    follow_next = not chapters and find_next_link(url, soup) is not None
+    if follow_next: chapters = [{"url": url, "title": page_title(soup)}]
+    if not chapters: return process_url_import(url)
+    title = page_title(soup) or "网页抓取_" + str(int(time.time()))
+    novel_id = create_novel_meta(title, "web", source_url=url)
+    with crawl_lock:
+        crawl_states[novel_id] = {"url": url, "status": "running", "follow_next": follow_next,
+                                  "created_at": time.time(), "updated_at": time.time(),
+                                  "chapters": [{**ch, "status": "pending"} for ch in chapters]}
+    persist_crawl(novel_id, force=True)
+    start_crawl(novel_id)
     return novel_id
 
+def sync_novel(novel_id):
+    """检查连载更新：重新读目录页，只下载新增的章节和目录上显示改过 (或无法判断) 的章节。
+    正文没变的章节 save_chapter 会保留译文。"""
+    meta = load_meta(novel_id)
+    if meta.get('type') != 'web' or not meta.get('source_url'): raise Exception("只有网页导入的小说可以检查更新")
+    state = crawl_state(novel_id)
+    with crawl_lock:
+        if state and ((state.get('_thread') and state['_thread'].is_alive()) or crawl_running_elsewhere(state)):
+            return crawl_progress(state)
+        if state is None:
+            # 单页导入的小说：只重新检查这一页
+            state = crawl_states[novel_id] = {"url": meta['source_url'], "status": "done", "follow_next": False,
+                                              "created_at": time.time(), "updated_at": time.time(),
+                                              "chapters": [{"url": meta['source_url'], "title": "", "status": "done"}]}
+    links = []
+    if not state.get('follow_next'):
+        links = discover_chapters(state['url'], BeautifulSoup(fetch_page(state['url']).text, HTML_PARSER))
+    with crawl_lock:
+        state['changed'] = 0
+        known = {ch['url']: ch for ch in state['chapters']}
+        for link in links:
+            ch = known.get(link['url'])
+            if ch is None:
+                state['chapters'].append({**link, "status": "pending"})
+            elif ch['status'] != 'done' or 'updated' not in link or link['updated'] != ch.get('updated'):
+                ch.update(link)
+                ch['status'] = 'pending'
+        if state.get('follow_next'):
+            # 「下一话」模式：重新完整下载最后一章，看有没有新的下一话链接
+            last = state['chapters'][-1]
+            last.pop('etag', None)
+            last.pop('last_modified', None)
+            last['status'] = 'pending'
+        elif not links:
+            for ch in state['chapters']: ch['status'] = 'pending'
+    persist_crawl(novel_id, force=True)
+    start_crawl(novel_id)
+    return crawl_progress(state)
+
+def web_novel_ids():
+    ids = []
+    for name in os.listdir(NOVELS_DIR):
+        if novel_exists(name):
+            meta = load_meta(name)
+            if meta.get('type') == 'web' and meta.get('source_url'): ids.append(name)
+    return ids
+
+def sync_all_novels():
+    """逐本检查更新 (一本抓完再下一本，避免同时压垮站点)"""
+    for novel_id in web_novel_ids():
+        try:
+            sync_novel(novel_id)
+            thread = crawl_states[novel_id].get('_thread')
+            if thread: thread.join()
+        except Exception as e:
+            print(f"[sync] {novel_id} 检查更新失败: {e}")
+
+def sync_scheduler():
+    while True:
+        time.sleep(SYNC_INTERVAL_HOURS * 3600)
+        sync_all_novels()
+
+def restore_crawls():
+    """启动时继续上次没抓完的小说"""
+    for name in os.listdir(NOVELS_DIR):
+        state = read_json(crawl_path(name))
+        if state is None: continue
+        with crawl_lock: crawl_states[name] = state
+        # 别的 worker 还在抓的不用管；owner 已经不在了的接着抓
+        if state['status'] == 'running' and not crawl_running_elsewhere(state): start_crawl(name)
+
+# ================= 翻译核心 =================
+PROMPT_TEMPLATE = ("你是一位轻小说翻译家。请翻译以下日语片段为中文，保留小说感和沉浸感。\n{glossary}"
+                   "译文写完后另起一行写 <<<术语>>>，再逐行列出片段中出现的人名、地名等专有名词，格式为「原文=译文」；没有就省略这一部分。\n\n{text}")
+GLOSSARY_PROMPT = "专有名词请沿用以下译名：\n{entries}\n"
+TERMS_MARKER = "<<<术语>>>"
+PROMPT_VERSION = 2  # 改动提示词时 +1，旧缓存自动失效
+
+class UpstreamError(Exception):
+    """服务商返回了非 200 响应"""
+
+class PartialTranslationError(Exception):
+    """部分段落翻译失败 (成功的段落已经保存)"""
+    def __init__(self, message, done, total):
+        super().__init__(message)
+        self.done, self.total = done, total
+
+def parse_settings(data):
+    """从请求里取出模型设置；fallbacks 是按顺序尝试的备用模型 / 服务商"""
+    settings = {
+        "provider": data.get('provider', 'gemini'),
+        "model": data.get('model', 'gemini-1.5-flash'),
+        "api_key": data.get('api_key') or DEFAULT_GEMINI_KEY,
+        "base_url": data.get('base_url'),
+    }
+    fallbacks = []
+    for fb in data.get('fallbacks') or []:
+        # 只写模型名时沿用主设置的服务商、Key 和地址
+        if isinstance(fb, str): fb = {"model": fb.strip()}
+        provider = fb.get('provider') or settings['provider']
+        same = provider == settings['provider']
+        fb = {"provider": provider, "model": fb.get('model') or settings['model'],
+              "api_key": fb.get('api_key') or (settings['api_key'] if same else DEFAULT_GEMINI_KEY if provider == 'gemini' else ""),
+              "base_url": fb.get('base_url') or (settings['base_url'] if same else None)}
+        if fb['api_key'] and (provider == 'gemini' or fb['base_url']): fallbacks.append(fb)
+    settings['fallbacks'] = fallbacks
+    return settings
+
+def public_settings(settings):
+    """去掉 Key 之后可以落盘的设置"""
+    return {**{k: v for k, v in settings.items() if k != 'api_key'},
+            "fallbacks": [{k: v for k, v in fb.items() if k != 'api_key'} for fb in settings.get('fallbacks', [])]}
+
+def provider_chain(settings):
+    """主设置 + 备用设置，按顺序尝试"""
+    return [settings] + list(settings.get('fallbacks') or [])
+
+def provider_family(provider):
+    return "gemini" if provider == 'gemini' else "openai"
+
+# ================= 服务商：复用客户端、自适应限速、重试 =================
+class RetryableError(UpstreamError):
+    """429 / 5xx / 网络错误，退避后可以重试"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_duration(value):
+    """解析 "1s"、"6m0s"、"20ms"、"0.5" 这类时长，返回秒"""
+    if not value: return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value)
+    return sum(float(n) * units[u] for n, u in parts) if parts else None
+
+class TokenBucket:
+    """令牌桶限速：被 429 时速率减半并暂停，成功后慢慢恢复；响应头里有额度信息时按头部调整"""
+    def __init__(self, rpm):
+        self.max_rate = self.rate = rpm / 60.0
+        self.tokens = self.capacity = max(1.0, self.rate)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(min(wait, 5))
+
+    def on_success(self):
+        with self.lock: self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + (1 if retry_after is None else retry_after))
+
+    def update_from_headers(self, headers):
+        """OpenAI 风格的 x-ratelimit-* 头：每分钟上限、剩余次数、多久后重置"""
+        limit = headers.get('x-ratelimit-limit-requests', '')
+        remaining = headers.get('x-ratelimit-remaining-requests', '')
+        reset = parse_duration(headers.get('x-ratelimit-reset-requests'))
+        with self.lock:
+            if limit.isdigit() and int(limit) > 0:
+                self.max_rate = int(limit) / 60.0
+                self.rate = min(self.rate, self.max_rate)
+            if remaining == '0' and reset:
+                self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+class ProviderSlots:
+    """服务商的并发名额：后台 (整本任务 / 预读) 最多占 n-1 个，留一个给读者正在等的章节；
+    有前台请求在等时，空出来的名额也先给前台"""
+    def __init__(self, n):
+        self.n = n
+        self.background_max = max(1, n - 1)
+        self.used = self.background_used = self.foreground_waiting = 0
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self, background=False):
+        with self.cond:
+            if background:
+                self.cond.wait_for(lambda: self.used < self.n and self.background_used < self.background_max and not self.foreground_waiting)
+                self.background_used += 1
+            else:
+                self.foreground_waiting += 1
+                self.cond.wait_for(lambda: self.used < self.n)
+                self.foreground_waiting -= 1
+            self.used += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= 1
+                if background: self.background_used -= 1
+                self.cond.notify_all()
+
+_provider_slots = {name: ProviderSlots(n) for name, n in PROVIDER_CONCURRENCY.items()}
+
+class GeminiProvider:
+    """复用按模型缓存的 GenerativeModel；genai.configure 是全局的，所以创建模型时立刻绑定当前 Key 的客户端"""
+    family = "gemini"
+    _configure_lock = threading.Lock()
+
+    def __init__(self, api_key, base_url=None):
+        self.api_key = api_key
+        self.bucket = TokenBucket(LLM_RPM['gemini'])
+        self.models = {}
+
+    def model(self, name):
+        if name not in self.models:
+            with GeminiProvider._configure_lock:
+                genai.configure(api_key=self.api_key)
+                model = genai.GenerativeModel(name)
+                model._client = genai_client.get_default_generative_client()
+                self.models[name] = model
+        return self.models[name]
+
+    def _wrap(self, e):
+        retryable = (gexc.TooManyRequests, gexc.ResourceExhausted, gexc.ServiceUnavailable,
+                     gexc.InternalServerError, gexc.DeadlineExceeded)
+        return RetryableError(str(e)) if isinstance(e, retryable) else UpstreamError(str(e))
+
+    @staticmethod
+    def _usage(response, usage):
+        meta = getattr(response, 'usage_metadata', None)
+        if meta and meta.prompt_token_count:
+            usage.update(prompt=meta.prompt_token_count, completion=meta.candidates_token_count)
+
+    def complete(self, model, prompt, usage):
+        try:
+            response = self.model(model).generate_content(prompt)
+            self._usage(response, usage)
+            return response.text
+        except gexc.GoogleAPIError as e:
+            raise self._wrap(e)
+
+    def stream(self, model, prompt, usage):
+        try:
+            for chunk in self.model(model).generate_content(prompt, stream=True):
+                self._usage(chunk, usage)  # 用量在最后一块里
+                try:
+                    text = chunk.text
+                except ValueError:  # 没有文本的块 (例如只带结束原因)
+                    continue
+                if text: yield text
+        except gexc.GoogleAPIError as e:
+            raise self._wrap(e)
+
+class OpenAIProvider:
+    """DeepSeek / OpenAI 兼容接口：每个 (Key, 地址) 一个带连接池的 Session"""
+    family = "openai"
+
+    def __init__(self, api_key, base_url):
+        self.url = base_url.rstrip('/') + "/chat/completions"
+        self.bucket = TokenBucket(LLM_RPM['openai'])
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(PROVIDER_CONCURRENCY['openai'] * 2, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _post(self, model, prompt, stream):
+        payload = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": stream}
+        try:
+            resp = self.session.post(self.url, json=payload, timeout=60, stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableError(str(e))
+        except requests.RequestException as e:
+            raise UpstreamError(str(e))
+        self.bucket.update_from_headers(resp.headers)
+        if resp.status_code == 429 or resp.status_code >= 500:
+            resp.close()
+            raise RetryableError(resp.text, parse_duration(resp.headers.get('Retry-After')))
+        if resp.status_code != 200: raise UpstreamError(resp.text)
+        return resp
+
+    @staticmethod
+    def _usage(data, usage):
+        if data.get('usage'):
+            usage.update(prompt=data['usage'].get('prompt_tokens', 0), completion=data['usage'].get('completion_tokens', 0))
+
+    def complete(self, model, prompt, usage):
+        data = self._post(model, prompt, False).json()
+        self._usage(data, usage)
+        return data['choices'][0]['message']['content']
+
+    def stream(self, model, prompt, usage):
+        # stream=True 时返回 SSE，每行 "data: {...}"，以 "data: [DONE]" 结束；部分服务商会在最后一块带上用量
+        with self._post(model, prompt, True) as resp:
+            # SSE 一律是 UTF-8；Content-Type 没带 charset 时 requests 会按 ISO-8859-1 解码，中日文全成乱码
+            resp.encoding = 'utf-8'
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"): continue
+                chunk = line[5:].strip()
+                if chunk == "[DONE]": break
+                data = json.loads(chunk)
+                self._usage(data, usage)
+                choices = data.get('choices') or [{}]
+                text = (choices[0].get('delta') or {}).get('content')
+                if text: yield text
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+def get_provider(settings):
+    """按 (服务商, Key, 地址) 复用客户端"""
+    family = provider_family(settings['provider'])
+    key = (family, settings['api_key'], (settings.get('base_url') or "").rstrip('/') if family == 'openai' else None)
+    with _providers_lock:
+        if key not in _providers:
+            cls = GeminiProvider if family == 'gemini' else OpenAIProvider
+            _providers[key] = cls(settings['api_key'], settings.get('base_url'))
+        return _providers[key]
+
+def backoff_delay(attempt, retry_after=None):
+    """指数退避 + 全抖动；服务商给了 Retry-After 就至少等那么久"""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+def record_llm(settings, started, outcome, prompt="", output="", usage=None):
+    """记一次模型调用的耗时和用量；服务商没返回用量时按字数估算"""
+    labels = {"provider": provider_family(settings['provider']), "model": settings['model']}
+    LLM_SECONDS.observe(time.perf_counter() - started, outcome=outcome, **labels)
+    if outcome != 'ok': return
+    usage = usage or {"prompt": estimate_tokens(prompt), "completion": estimate_tokens(output)}
+    LLM_TOKENS.inc(usage['prompt'], kind="prompt", **labels)
+    LLM_TOKENS.inc(usage['completion'], kind="completion", **labels)
+
+def call_llm(settings, prompt, background=False):
+    """调用一个服务商，返回译文；限速、并发上限、可重试错误的退避都在这里。background：后台任务的调用"""
+    provider = get_provider(settings)
+    for attempt in range(LLM_RETRIES + 1):
+        provider.bucket.acquire()
+        started, usage = time.perf_counter(), {}
+        try:
+            with _provider_slots[provider.family].slot(background):
+                text = provider.complete(settings['model'], prompt, usage)
+            provider.bucket.on_success()
+            record_llm(settings, started, 'ok', prompt, text, usage)
+            return text
+        except RetryableError as e:
+            record_llm(settings, started, 'throttled')
+            provider.bucket.on_throttle(e.retry_after)
+            if attempt == LLM_RETRIES: raise
+            time.sleep(backoff_delay(attempt, e.retry_after))
+        except Exception:
+            record_llm(settings, started, 'error')
+            raise
+
+def stream_llm(settings, prompt):
+    """流式调用一个服务商，逐块 yield 译文；还没收到任何内容前出错才会重试"""
+    provider = get_provider(settings)
+    for attempt in range(LLM_RETRIES + 1):
+        provider.bucket.acquire()
+        started, usage, parts = time.perf_counter(), {}, []
+        try:
+            with _provider_slots[provider.family].slot():
+                for text in provider.stream(settings['model'], prompt, usage):
+                    parts.append(text)
+                    yield text
+            provider.bucket.on_success()
+            record_llm(settings, started, 'ok', prompt, "".join(parts), usage)
+            return
+        except RetryableError as e:
+            record_llm(settings, started, 'throttled')
+            provider.bucket.on_throttle(e.retry_after)
+            if parts or attempt == LLM_RETRIES: raise
+            time.sleep(backoff_delay(attempt, e.retry_after))
+        except Exception:
+            record_llm(settings, started, 'error')
+            raise
+
+# ---- 译文缓存 ----
+class TranslationCache:
+    """持久化的译文缓存 (SQLite)，总大小超过上限时淘汰最久未用的条目。
+    缓存出错 (比如别的进程长时间占着库) 只打印出来，不影响翻译本身"""
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, translation TEXT, size INTEGER, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (last_used)")
+        self.conn.commit()
+        self._resync()
+
+    def _resync(self):
+        # 别的进程写入 / 淘汰的条目不会反映在本进程的计数里，按库里的实际大小校正
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self.synced_at = time.monotonic()
+
+    @staticmethod
+    def make_key(text, settings, glossary=""):
+        # 统一全角/半角并去掉行首尾空白，同一段落换个排版也能命中
+        normalized = "\n".join(line.strip() for line in unicodedata.normalize("NFKC", text).strip().split("\n"))
+        endpoint = "" if settings['provider'] == 'gemini' else (settings.get('base_url') or "").rstrip('/')
+        # 附带的术语不同，译文也可能不同
+        glossary_hash = hashlib.sha1(glossary.encode('utf-8')).hexdigest() if glossary else ""
+        raw = "\x00".join([normalized, settings['provider'], endpoint, settings['model'], str(PROMPT_VERSION), glossary_hash])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = None
+            try:
+                row = self.conn.execute("SELECT translation FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                print(f"[cache] 读取失败: {e}")
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, translation):
+        size = len(translation.encode('utf-8'))
+        with self.lock:
+            try:
+                old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+                self.conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, translation, size, time.time()))
+                if time.monotonic() - self.synced_at > CACHE_RESYNC_SECONDS: self._resync()
+                else: self.total_bytes += size - (old[0] if old else 0)
+                if self.total_bytes > self.max_bytes: self._evict()
+                self.conn.commit()
+            except sqlite3.Error as e:
+                # 译文已经花钱拿到了，缓存写不进去也照常返回
+                self.conn.rollback()
+                print(f"[cache] 写入失败: {e}")
+
+    def _evict(self):
+        """淘汰到上限的 90%，避免每次写入都触发"""
+        # 多个进程共用缓存库时各自的计数会漂移，淘汰前按库里的实际大小校正
+        self._resync()
+        target = self.max_bytes * 0.9
+        for key, size in self.conn.execute("SELECT key, size FROM cache ORDER BY last_used").fetchall():
+            if self.total_bytes <= target: break
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.total_bytes -= size
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"entries": entries, "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
+
+translation_cache = TranslationCache(CACHE_DB, CACHE_MAX_MB * 1024 * 1024)
+Gauge("astral_cache_hits_total", "译文缓存命中次数", lambda: translation_cache.hits, kind="counter")
+Gauge("astral_cache_misses_total", "译文缓存未命中次数", lambda: translation_cache.misses, kind="counter")
+Gauge("astral_cache_bytes", "译文缓存占用的字节数", lambda: translation_cache.total_bytes, shared=True)
+
+def translate_segment(settings, text, use_cache=True, glossary="", background=False):
+    """翻译一段：先查缓存，没有再调用服务商；主设置失败时依次换备用设置。
+    返回模型的原始输出 (末尾可能带术语块，用 split_terms 拆开)"""
+    prompt = PROMPT_TEMPLATE.format(glossary=glossary, text=text)
+    error = None
+    for candidate in provider_chain(settings):
+        key = TranslationCache.make_key(text, candidate, glossary)
+        if use_cache:
+            cached = translation_cache.get(key)
+            if cached is not None: return cached
+        try:
+            trans_text = call_llm(candidate, prompt, background)
+        except Exception as e:
+            error = e
+            continue
+        translation_cache.put(key, trans_text)
+        return trans_text
+    raise error
+
+def stream_segment(settings, text, use_cache=True, glossary=""):
+    """流式翻译一段：缓存命中时一次性返回，否则边收边转发，收完写入缓存。
+    还没转发任何内容时失败会换备用设置；转发到一半失败就直接报错。"""
+    prompt = PROMPT_TEMPLATE.format(glossary=glossary, text=text)
+    error = None
+    for candidate in provider_chain(settings):
+        key = TranslationCache.make_key(text, candidate, glossary)
+        cached = translation_cache.get(key) if use_cache else None
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        try:
+            for delta in stream_llm(candidate, prompt):
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            if parts: raise
+            error = e
+            continue
+        translation_cache.put(key, "".join(parts))
+        return
+    raise error
+
+# ---- 术语表：从已有译文里积累人名 / 地名，翻译时只附带本段出现过的 ----
+class TermIndex:
+    """Aho-Corasick 多模式匹配：扫一遍文本就找出其中出现的全部术语"""
+    def __init__(self, words):
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+        for word in words:
+            state = 0
+            for ch in word:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = nxt
+            self.out[state].append(word)
+        # 按层序 (BFS) 补上失配指针，并把失配链上的输出合并进来
+        pending = list(self.goto[0].values())
+        for state in pending:
+            for ch, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]: f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                pending.append(nxt)
+
+    def find(self, text):
+        """返回 {术语: 出现次数}"""
+        found, state = {}, 0
+        for ch in text:
+            while state and ch not in self.goto[state]: state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for word in self.out[state]: found[word] = found.get(word, 0) + 1
+        return found
+
+class Glossary:
+    """一本小说的术语表 (存在 novel.db 的 glossary 表)；匹配索引在术语变动后重建"""
+    def __init__(self, novel_id):
+        self.novel_id = novel_id
+        self.lock = threading.Lock()
+        self.entries, self.index, self.version = {}, None, None
+
+    def _refresh(self):
+        version = novel_db(self.novel_id).execute("SELECT COUNT(*), MAX(updated_at) FROM glossary").fetchone()
+        with self.lock:
+            if version == self.version: return self.entries, self.index
+            self.entries = dict(novel_db(self.novel_id).execute("SELECT src, dst FROM glossary"))
+            self.index = TermIndex(self.entries) if self.entries else None
+            self.version = version
+            return self.entries, self.index
+
+    def prompt_block(self, text):
+        """本段原文里出现过的术语，拼成提示词片段；出现次数多、长的优先"""
+        entries, index = self._refresh()
+        if index is None: return ""
+        found = index.find(text)
+        # 短词被更长的术语包含时 (如「アル」在「アルベルト」里) 不单独列出
+        terms = [w for w in found if not any(w != o and w in o for o in found)]
+        terms.sort(key=lambda w: (-found[w], -len(w)))
+        terms = sorted(terms[:GLOSSARY_MAX_TERMS])
+        if not terms: return ""
+        return GLOSSARY_PROMPT.format(entries="\n".join(f"{w}={entries[w]}" for w in terms))
+
+    def learn(self, terms, source_text):
+        """记下模型报告的新术语：只收原文里真实出现的，已有的译名不覆盖 (先到先得，保证前后一致)"""
+        rows = [(src, dst, time.time()) for src, dst in terms.items() if src in source_text]
+        if not rows: return 0
+        conn = novel_db(self.novel_id)
+        with conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO glossary (src, dst, source, updated_at) VALUES (?, ?, 'auto', ?)", rows)
+            return conn.total_changes - before
+
+    def list(self):
+        rows = novel_db(self.novel_id).execute("SELECT src, dst, source FROM glossary ORDER BY source DESC, src")
+        return [{"src": r[0], "dst": r[1], "source": r[2]} for r in rows]
+
+    def update(self, entries, replace=False):
+        """手动编辑：改过的译名标记为 manual；译文留空表示删除；replace 时删掉没有提交的条目"""
+        conn = novel_db(self.novel_id)
+        with write_txn(conn):
+            current = dict(conn.execute("SELECT src, dst FROM glossary"))
+            for src, dst in entries:
+                if not dst: conn.execute("DELETE FROM glossary WHERE src = ?", (src,))
+                elif current.get(src) != dst: conn.execute("INSERT OR REPLACE INTO glossary VALUES (?, ?, 'manual', ?)", (src, dst, time.time()))
+            if replace:
+                kept = {src for src, _ in entries}
+                conn.executemany("DELETE FROM glossary WHERE src = ?", [(src,) for src in current if src not in kept])
+
+_glossaries = {}
+_glossaries_lock = threading.Lock()
+
+def get_glossary(novel_id):
+    with _glossaries_lock:
+        glossary = _glossaries.get(novel_id)
+        if glossary is None: glossary = _glossaries[novel_id] = Glossary(novel_id)
+        return glossary
+
+_TERM_LINE_RE = re.compile(r'^[\s\-*・「]*(.+?)\s*[=＝]\s*(.+?)[」\s]*$')
+
+def split_terms(raw):
+    """把模型输出拆成 (译文, {原文: 译名})"""
+    translation, marker, tail = raw.partition(TERMS_MARKER)
+    terms = {}
+    for line in tail.split("\n"):
+        m = _TERM_LINE_RE.match(line)
+        if m and len(m.group(1)) <= 30 and len(m.group(2)) <= 30: terms[m.group(1)] = m.group(2)
+    return (translation.rstrip() if marker else translation), terms
+
+class TermsFilter:
+    """流式转发时拦下术语块：标记可能被拆在两个分片里，所以总留一小截等下一片"""
+    def __init__(self):
+        self.raw, self.pending, self.cut = [], "", False
+
+    def feed(self, delta):
+        self.raw.append(delta)
+        if self.cut: return ""
+        self.pending += delta
+        pos = self.pending.find(TERMS_MARKER)
+        if pos >= 0:
+            self.cut = True
+            return self.pending[:pos].rstrip()
+        # 标记前的换行也先留着，免得译文末尾多出空行
+        keep = len(TERMS_MARKER) - 1
+        out = self.pending[:-keep].rstrip()
+        self.pending = self.pending[len(out):]
+        return out
+
+    def flush(self):
+        if self.cut: return ""
+        out, self.pending = self.pending, ""
+        return out
+
+    def result(self):
+        return split_terms("".join(self.raw))
+
+# ---- 分段：按段落 / 句子切分，每段不超过 token 预算 ----
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_SENTENCE_RE = re.compile(r'(?<=[。！？!?…」』）])')
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日文字约 1 字 1 token，其余约 4 字符 1 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+def _split_long_line(line, budget):
+    """单行超出预算时按句子切；单句还超出就按长度硬切"""
+    pieces, buf = [], ""
+    for sentence in _SENTENCE_RE.split(line):
+        if buf and estimate_tokens(buf + sentence) > budget:
+            pieces.append(buf)
+            buf = ""
+        # 按中日文 1 字 1 token 的最坏情况切
+        while estimate_tokens(sentence) > budget:
+            pieces.append(sentence[:budget])
+            sentence = sentence[budget:]
+        buf += sentence
+    if buf: pieces.append(buf)
+    return pieces
+
+def split_segments(text, budget=None):
+    """把章节切成若干段，返回 [{"src", "trans", "sep"}]；把各段的 src + sep 拼起来就是原文"""
+    budget = budget or SEGMENT_TOKENS
+    segments, lines, used = [], [], 0
+
+    def flush():
+        if lines: segments.append({"src": "\n".join(lines), "trans": "", "sep": "\n"})
+        lines.clear()
+
+    for line in text.split("\n"):
+        cost = estimate_tokens(line) + 1
+        if cost > budget:
+            flush()
+            used = 0
+            for piece in _split_long_line(line, budget): segments.append({"src": piece, "trans": "", "sep": ""})
+            segments[-1]['sep'] = "\n"
+            continue
+        if lines and used + cost > budget:
+            flush()
+            used = 0
+        lines.append(line)
+        used += cost
+    flush()
+    if segments: segments[-1]['sep'] = ""
+    # 纯空白的段不需要翻译
+    for seg in segments:
+        if not seg['src'].strip(): seg['trans'] = seg['src']
+    return segments
+
+def join_segments(segments):
+    return "".join((seg['trans'].strip("\n") if seg['src'].strip() else seg['trans']) + seg['sep'] for seg in segments)
+
+def prepare_segments(chapter_data):
+    """切分章节；已有完整译文时视为重新翻译 (不读缓存)，否则复用上次成功的段落。
+    重新翻译中途失败时旧译文保留、分段进度里留有没完成的段：这时仍不读缓存，但复用这次已经重翻好的段落。"""
+    segments = split_segments(chapter_data['content'])
+    retranslate = bool(chapter_data.get('translation'))
+    stored = chapter_data.get('segments', [])
+    if not retranslate or any(not seg.get('trans') for seg in stored):
+        done_before = {seg['src']: seg['trans'] for seg in chapter_data.get('segments', []) if seg.get('trans')}
+        for seg in segments:
+            if not seg['trans']: seg['trans'] = done_before.get(seg['src'], "")
+    return segments, retranslate
+
+def translate_chapter(novel_id, chapter_index, settings, background=False):
+    """分段翻译一章并保存译文；失败的段落下次重试时才会重新发送。background：后台任务 / 预读，不占前台的并发名额"""
+    chapter_data = load_chapter(novel_id, chapter_index)
+    if chapter_data is None: raise Exception(f"章节 {chapter_index} 不存在")
+    segments, retranslate = prepare_segments(chapter_data)
+    todo = [seg for seg in segments if not seg['trans']]
+    glossary = get_glossary(novel_id)
+    errors = []
+    if todo:
+        with ThreadPoolExecutor(max_workers=min(SEGMENT_CONCURRENCY, len(todo))) as pool:
+            futures = {pool.submit(translate_segment, settings, seg['src'], not retranslate, glossary.prompt_block(seg['src']), background): seg
+                       for seg in todo}
+            for fut in as_completed(futures):
+                seg = futures[fut]
+                try:
+                    seg['trans'], terms = split_terms(fut.result())
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                glossary.learn(terms, seg['src'])
+
+    # 有段落失败时只保存分段进度，已有的整章译文要等新译文完整了才替换
+    trans_text = None if errors else join_segments(segments)
+    save_translation(novel_id, chapter_index, trans_text, segments)
+    if errors:
+        done = sum(1 for seg in segments if seg['trans'])
+        message = f"{len(errors)} 段翻译失败 (已完成 {done}/{len(segments)} 段，重试只会重发失败的段落)：{errors[0]}"
+        if len(errors) == len(todo) and isinstance(errors[0], UpstreamError): raise UpstreamError(message)
+        raise PartialTranslationError(message, done, len(segments))
+    return trans_text
+
+# ================= 后台任务：整本翻译队列 =================
+# 任务状态保存在 meta.json 旁边的 jobs.json 里，重启后可以恢复。
+# API Key 只保存在内存中 (job_secrets)，不落盘；重启后需要用户重新提供 (使用默认 Key 的任务会自动继续)。
+# 队列按优先级取：预读 (读者马上要看) 排在整本任务前面。
+job_queue = queue.PriorityQueue()
+jobs = {}
+job_secrets = {}
+jobs_lock = threading.RLock()
+_workers = []
+_job_seq = itertools.count()
+_translating = set()  # (novel_id, idx)：本进程正在翻译的章节 (各进程共用的记录在 novel.db 的 inflight 表)
+Gauge("astral_job_queue_depth", "翻译队列里等待的章节数", lambda: job_queue.qsize())
+Gauge("astral_chapters_translating", "正在翻译的章节数", lambda: len(_translating))
+
+# ---- 正在翻译的章节：记在 novel.db 里，所有 worker 进程都能看到，同一章不会被两处同时翻译 ----
+def claim_chapter(novel_id, idx):
+    """占住这一章；已被 (还活着的) 别处占着返回 False。负责的进程退出后留下的记录直接接手"""
+    conn = novel_db(novel_id)
+    with write_txn(conn):
+        row = conn.execute("SELECT owner FROM inflight WHERE idx = ?", (int(idx),)).fetchone()
+        if row and owner_alive(row[0]): return False
+        conn.execute("INSERT OR REPLACE INTO inflight VALUES (?, ?, ?)", (int(idx), process_id(), time.time()))
+    with jobs_lock: _translating.add((novel_id, int(idx)))
+    return True
+
+def release_chapter(novel_id, idx):
+    conn = novel_db(novel_id)
+    with write_txn(conn):
+        conn.execute("DELETE FROM inflight WHERE idx = ? AND owner = ?", (int(idx), process_id()))
+    with jobs_lock: _translating.discard((novel_id, int(idx)))
+
+def chapter_in_flight(novel_id, idx):
+    row = novel_db(novel_id).execute("SELECT owner FROM inflight WHERE idx = ?", (int(idx),)).fetchone()
+    return bool(row) and owner_alive(row[0])
+
+def claim_chapter_wait(novel_id, idx, timeout=300):
+    """占住这一章，被别处占着就等它翻完 (最多 timeout 秒)；返回 (是否占到, 是否等过)"""
+    deadline, waited = time.monotonic() + timeout, False
+    while not claim_chapter(novel_id, idx):
+        if time.monotonic() > deadline: return False, waited
+        waited = True
+        time.sleep(0.5)
+    return True, waited
+
+def jobs_path(novel_id):
+    return os.path.join(NOVELS_DIR, novel_id, "jobs.json")
+
+def _owned_jobs(novel_id, saved):
+    """本进程内存里、仍由本进程负责的任务 (调用方持有 jobs_lock)。
+    jobs.json 里已经换了 owner 的 (被别的 worker 继续了)，本地的旧副本作废，以文件为准"""
+    owned = {}
+    for jid, job in list(jobs.items()):
+        if job['novel_id'] != novel_id or job.get('kind') == 'prefetch': continue
+        if job.get('owner') != process_id() or saved.get(jid, job).get('owner') != process_id():
+            jobs.pop(jid, None)
+            job_secrets.pop(jid, None)
+            continue
+        owned[jid] = job
+    return owned
+
+def persist_jobs(novel_id):
+    """把本进程负责的任务合并写回 jobs.json (别的进程的任务原样保留)；
+    别的进程在文件里标记了取消 (cancel_requested) 的任务，在这里生效"""
+    path = jobs_path(novel_id)
+    with jobs_lock, file_lock(path):
+        saved = read_json(path, {})
+        for jid, job in _owned_jobs(novel_id, saved).items():
+            if saved.get(jid, {}).get('cancel_requested') and job['status'] in ('queued', 'running'):
+                job['status'] = 'cancelled'
+                job_secrets.pop(jid, None)
+            saved[jid] = job
+        write_json(path, saved)
+
+def job_active(job):
+    """排队 / 运行中，并且负责它的进程还活着"""
+    return job['status'] in ('queued', 'running') and owner_alive(job.get('owner'))
+
+def novel_jobs(novel_id):
+    """这本小说的全部任务：jobs.json 里的，本进程负责的换成内存里的最新状态"""
+    with jobs_lock:
+        saved = read_json(jobs_path(novel_id), {})
+        saved.update(_owned_jobs(novel_id, saved))
+        return saved
+
+def job_progress(job):
+    done, total = len(job['done']), job['total']
+    return {**job, "progress": round(done / total, 4) if total else 1.0}
+
+def _queue_chapter(job, idx):
+    job_queue.put((0 if job.get('kind') == 'prefetch' else 1, next(_job_seq), job['id'], idx))
+
+def _adopt_job(job, settings, saved):
+    """本进程接手任务 (调用方持有 jobs_lock 和 jobs.json 的文件锁，saved 是刚读出的 jobs.json)：
+    失败的章节放回待翻，owner 改成本进程写回文件，别的进程里这个任务的旧副本随之作废"""
+    jobs[job['id']] = job
+    job_secrets[job['id']] = settings
+    job['owner'] = process_id()
+    job.pop('cancel_requested', None)
+    job['status'] = 'queued'
+    job['pending'] = sorted(set(job['pending']) | set(int(i) for i in job['failed']))
+    job['failed'] = {}
+    job['updated_at'] = time.time()
+    if not job['pending']: job['status'] = 'done'
+    saved[job['id']] = job
+    write_json(jobs_path(job['novel_id']), saved)
+
+def _queue_job(job):
+    ensure_workers()
+    for idx in job['pending']: _queue_chapter(job, idx)
+
+def enqueue_job(job, settings):
+    """把任务剩余的章节放进队列；settings 是带 Key 的完整设置"""
+    path = jobs_path(job['novel_id'])
+    with jobs_lock, file_lock(path): _adopt_job(job, settings, read_json(path, {}))
+    _queue_job(job)
+
+def create_translate_job(novel_id, settings):
+    """为一本小说里所有未翻译的章节创建任务；已有进行中的任务时直接返回它。
+    检查和登记在同一把跨进程文件锁里，两个 worker 同时收到「整本翻译」也只会建一个任务"""
+    path = jobs_path(novel_id)
+    with jobs_lock, file_lock(path):
+        for job in novel_jobs(novel_id).values():
+            if job_active(job): return job
+        pending = [ch['index'] for ch in list_chapters(novel_id) if not ch['has_trans']]
+        job = {
+            "id": uuid.uuid4().hex[:12], "novel_id": novel_id, "status": "queued",
+            "settings": public_settings(settings),
+            "default_key": settings['api_key'] == DEFAULT_GEMINI_KEY,
+            "pending": pending, "done": [], "failed": {}, "total": len(pending),
+            "created_at": time.time(), "updated_at": time.time(),
+        }
+        _adopt_job(job, settings, read_json(path, {}))
+    _queue_job(job)
+    return job
+
+def _finish_chapter(job, idx, error=None):
+    with jobs_lock:
+        if idx in job['pending']: job['pending'].remove(idx)
+        if error is None: job['done'].append(idx)
+        else: job['failed'][str(idx)] = error
+        job['updated_at'] = time.time()
+        if job['status'] == 'running' and not job['pending']:
+            job['status'] = 'failed' if job['failed'] else 'done'
+            job_secrets.pop(job['id'], None)
+        if job.get('kind') != 'prefetch': persist_jobs(job['novel_id'])
+
+def _job_worker():
+    while True:
+        _, _, job_id, idx = job_queue.get()
+        job = None
+        try:
+            with jobs_lock:
+                job = jobs.get(job_id)
+                # 已取消 / 暂停的任务：队列里剩下的章节直接丢掉
+                if not job or job['status'] not in ('queued', 'running') or idx not in job['pending']: continue
+                job['status'] = 'running'
+                settings = job_secrets.get(job_id)
+            novel_id, claimed = job['novel_id'], False
+            try:
+                if job.get('kind') == 'prefetch':
+                    # 读者已经跳到别处 (新的预读可能是别的 worker 发起的)，或者这一章正在别处翻译：预读直接跳过
+                    claimed = prefetch_current(job) and claim_chapter(novel_id, idx)
+                    if not claimed:
+                        _finish_chapter(job, idx)
+                        continue
+                else:
+                    claimed = claim_chapter_wait(novel_id, idx)[0]
+                    if not claimed:
+                        _finish_chapter(job, idx, "这一章正在别处翻译")
+                        continue
+                # 重启前已经翻完但没来得及记录的章节、等待期间别处刚翻完的章节，不再重复花钱
+                if not novel_db(novel_id).execute("SELECT translated FROM chapters WHERE idx = ?", (idx,)).fetchone()[0]:
+                    translate_chapter(novel_id, idx, settings, background=True)
+                _finish_chapter(job, idx)
+            except Exception as e:
+                _finish_chapter(job, idx, str(e))
+            finally:
+                if claimed: release_chapter(novel_id, idx)
+        finally:
+            if job is not None and job.get('kind') == 'prefetch': _release_prefetch(job, idx)
+            job_queue.task_done()
+
+def ensure_workers():
+    """按需启动固定数量的工作线程"""
+    with jobs_lock:
+        while len(_workers) < JOB_WORKERS:
+            t = threading.Thread(target=_job_worker, daemon=True)
+            t.start()
+            _workers.append(t)
+
+# ---- 预读：每个 Key 只保留一个预读任务，读者跳到别处时取消旧的 ----
+# 读者的请求可能落在任意一个 worker 上，所以「每个 Key 当前的预读任务」和「各进程已放进队列的章数」记在共用的
+# .prefetch.json 里：新任务登记后旧任务 (不管在哪个进程) 就不再排新章节，预读章数的上限也按所有进程合计。
+PREFETCH_STATE = os.path.join(NOVELS_DIR, ".prefetch.json")
+
+def key_id(settings):
+    """区分不同读者 / Key，不保存 Key 本身"""
+    return hashlib.sha1(f"{settings['provider']}\x00{settings['api_key']}".encode('utf-8')).hexdigest()[:12]
+
+@contextlib.contextmanager
+def prefetch_state():
+    """加锁读写 .prefetch.json：{key_id: {"job", "owner", "inflight": {进程: 已放进队列的章数}}}"""
+    with file_lock(PREFETCH_STATE):
+        state = read_json(PREFETCH_STATE, {})
+        yield state
+        write_json(PREFETCH_STATE, state)
+
+def prefetch_current(job):
+    """这个预读任务是否还是它那个 Key 的当前任务 (读者没有跳到别处)"""
+    return (read_json(PREFETCH_STATE, {}).get(job['key_id']) or {}).get('job') == job['id']
+
+def _prefetch_used(entry):
+    """还活着的进程里，这个 Key 已放进队列还没翻完的章数"""
+    inflight = entry.setdefault('inflight', {})
+    for owner in [owner for owner in inflight if not owner_alive(owner)]: del inflight[owner]
+    return sum(inflight.values())
+
+def start_prefetch(novel_id, chapter_index, settings, depth=None):
+    """在后台翻译第 chapter_index 章之后的 depth 章 (跳过已翻译和正在翻译的)"""
+    depth = max(0, min(PREFETCH_MAX_DEPTH, PREFETCH_DEPTH if depth in (None, "") else int(depth)))
+    rows = novel_db(novel_id).execute("SELECT idx, translated FROM chapters WHERE idx > ? ORDER BY idx LIMIT ?",
+                                      (int(chapter_index), depth)).fetchall()
+    kid = key_id(settings)
+    with jobs_lock, prefetch_state() as state:
+        entry = state.get(kid) or {}
+        old = jobs.get(entry.get('job'))
+        if old:
+            # 同一位置重复请求 (打开页面、点翻译) 沿用原来的任务
+            if old['status'] in ('queued', 'running') and old['novel_id'] == novel_id and old['from'] == int(chapter_index) and old['depth'] == depth:
+                return old
+            if old['status'] in ('queued', 'running'):
+                old['status'] = 'cancelled'
+                job_secrets.pop(old['id'], None)
+            if not old['queued']: jobs.pop(old['id'], None)
+        pending = [idx for idx, translated in rows if not translated and not chapter_in_flight(novel_id, idx)]
+        job = {
+            "id": uuid.uuid4().hex[:12], "novel_id": novel_id, "kind": "prefetch", "key_id": kid,
+            "status": "queued" if pending else "done", "from": int(chapter_index), "depth": depth,
+            "settings": public_settings(settings), "pending": pending, "queued": [], "done": [], "failed": {},
+            "total": len(pending), "created_at": time.time(), "updated_at": time.time(),
+        }
+        jobs[job['id']] = job
+        # 发起预读的进程已经退出的 Key 不再留着
+        for other in [k for k, e in state.items() if k != kid and not owner_alive(e.get('owner'))]: del state[other]
+        # 别的进程里的旧任务看到这里换了 job 就会停下，已放进队列的章数原样留给新任务算
+        state[kid] = {"job": job['id'], "owner": process_id(), "inflight": entry.get('inflight', {})}
+        if pending: job_secrets[job['id']] = settings
+    ensure_workers()
+    _pump_prefetch(kid)
+    return job
+
+def _pump_prefetch(kid):
+    """在这个 Key 的预算内把预读章节放进队列，翻完一章再放下一章"""
+    retry = False
+    with jobs_lock, prefetch_state() as state:
+        entry = state.get(kid) or {}
+        job = jobs.get(entry.get('job'))
+        if not job or job['status'] not in ('queued', 'running'): return
+        used = _prefetch_used(entry)
+        mine = entry['inflight'].get(process_id(), 0)
+        for idx in job['pending']:
+            if idx in job['queued']: continue
+            if used >= PREFETCH_BUDGET:
+                # 名额被别的 worker 上已被取代的旧预读占着：它翻完不会通知这里，过一会儿再看
+                retry = used > mine
+                break
+            job['queued'].append(idx)
+            used, mine = used + 1, mine + 1
+            _queue_chapter(job, idx)
+        entry['inflight'][process_id()] = mine
+    if retry: threading.Timer(1.0, _pump_prefetch, (kid,)).start()
+
+def _release_prefetch(job, idx):
+    kid = job['key_id']
+    with jobs_lock, prefetch_state() as state:
+        entry = state.get(kid)
+        if idx in job['queued']:
+            job['queued'].remove(idx)
+            if entry:
+                inflight = entry.setdefault('inflight', {})
+                inflight[process_id()] = max(0, inflight.get(process_id(), 0) - 1)
+        # 被取代的旧任务：不再排新章节，最后一章出队后清理掉
+        if (entry or {}).get('job') != job['id']:
+            if job['status'] in ('queued', 'running'):
+                job['status'] = 'cancelled'
+                job_secrets.pop(job['id'], None)
+            if not job['queued']: jobs.pop(job['id'], None)
+    _pump_prefetch(kid)
+
+@contextlib.contextmanager
+def foreground_translation(novel_id, idx, timeout=300):
+    """读者点了翻译：这一章正在别处 (预读 / 整本任务 / 别的读者，可能在别的 worker 上) 翻译时先等它翻完，
+    yield 刚翻好的译文 (没有就是 None)，免得同一章花两次钱；翻译期间占住这一章，后台不会再翻它"""
+    before = (load_chapter(novel_id, idx) or {}).get('translation') if chapter_in_flight(novel_id, idx) else None
+    claimed, waited = claim_chapter_wait(novel_id, idx, timeout)
+    after = (load_chapter(novel_id, idx) or {}).get('translation') if waited else None
+    try:
+        yield after if after and after != before else None
+    finally:
+        if claimed: release_chapter(novel_id, idx)
+
+def restore_jobs():
+    """启动时从各小说目录的 jobs.json 恢复任务"""
+    if not os.path.exists(NOVELS_DIR): return
+    for name in os.listdir(NOVELS_DIR):
+        path = jobs_path(name)
+        if not os.path.exists(path): continue
+        saved = read_json(path, {})
+        for job in saved.values():
+            # 只接手负责进程已经不在了的任务 (多 worker 时别的 worker 可能正在跑)
+            if job['status'] not in ('queued', 'running') or owner_alive(job.get('owner')): continue
+            if job.get('default_key') and DEFAULT_GEMINI_KEY:
+                enqueue_job(job, parse_settings({**job['settings'], "api_key": DEFAULT_GEMINI_KEY}))
+            else:
+                with jobs_lock, file_lock(path):
+                    job.update(status='paused', owner=process_id())
+                    jobs[job['id']] = job
+                    current = read_json(path, {})
+                    current[job['id']] = job
+                    write_json(path, current)
+
+# ================= 导出：整本 TXT / EPUB =================
+# 一章一章地读库、一章一章地输出 (chunked 传输)，不在内存里拼整本书。
+# 同时把输出写进 exports/ 缓存，下次章节没变就直接发缓存文件。
+EXPORT_FORMATS = ("txt", "epub")
+EXPORT_MODES = ("translation", "bilingual")
+EPUB_CSS = "body { line-height: 1.8; } p { margin: 0 0 0.8em; } p.src { color: #888; font-size: 0.9em; margin-bottom: 0.2em; }"
+
+def bilingual_pairs(chapter):
+    """按分段把原文和译文对齐成 [(原文, 译文)]；段内行数一致时逐行对齐"""
+    pieces = chapter['segments'] if chapter['segments'] and all(seg['trans'] for seg in chapter['segments']) else \
+        [{"src": chapter['content'], "trans": chapter['translation']}]
+    pairs = []
+    for seg in pieces:
+        src_lines = [line for line in seg['src'].split("\n") if line.strip()]
+        trans_lines = [line for line in seg['trans'].split("\n") if line.strip()]
+        if len(src_lines) == len(trans_lines): pairs.extend(zip(src_lines, trans_lines))
+        elif src_lines or trans_lines: pairs.append(("\n".join(src_lines), "\n".join(trans_lines)))
+    return pairs
+
+def iter_export_chapters(novel_id):
+    for ch in list_chapters(novel_id):
+        chapter = load_chapter(novel_id, ch['index'])
+        if chapter is not None: yield chapter
+
+def export_txt(novel_id, mode):
+    """逐章输出 TXT 的字节块；没翻译的章节用原文"""
+    yield (load_meta(novel_id).get('title', novel_id) + "\n\n").encode('utf-8')
+    for chapter in iter_export_chapters(novel_id):
+        if mode == 'bilingual' and chapter['translation']:
+            body = "\n\n".join(f"{src}\n{trans}" for src, trans in bilingual_pairs(chapter))
+        else:
+            body = chapter['translation'] or chapter['content']
+        yield f"\n{chapter['title']}\n\n{body.strip()}\n".encode('utf-8')
+
+class _ChunkSink:
+    """给 zipfile 用的只写「文件」：写进来的字节攒着，由生成器取走发给客户端。
+    不支持 seek，zipfile 会改用数据描述符 (data descriptor)，不需要回头改文件头。"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def _xhtml(title, body):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="zh">\n'
+            f'<head><meta charset="utf-8"/><title>{html.escape(title)}</title><link rel="stylesheet" type="text/css" href="style.css"/></head>\n'
+            f'<body>\n{body}\n</body>\n</html>\n')
+
+def _paragraphs(text, css_class=None):
+    attr = f' class="{css_class}"' if css_class else ""
+    return "\n".join(f"<p{attr}>{html.escape(line.strip())}</p>" for line in text.split("\n") if line.strip())
+
+def export_epub(novel_id, mode):
+    """逐章输出 EPUB 3 的字节块。ebooklib 的 write_epub 要先在内存里建好整本书并写到可 seek 的文件，
+    几千章的书吃不消，所以这里直接用 zipfile 按章写 XHTML，目录和 OPF 最后再写。"""
+    meta = load_meta(novel_id)
+    title = meta.get('title', novel_id)
+    sink = _ChunkSink()
+    book = zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED)
+    # mimetype 必须是第一个文件且不压缩
+    book.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+    book.writestr("META-INF/container.xml",
+                  '<?xml version="1.0" encoding="utf-8"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                  '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+    book.writestr("OEBPS/style.css", EPUB_CSS)
+    yield sink.drain()
+
+    toc = []
+    for chapter in iter_export_chapters(novel_id):
+        name = f"chap_{chapter['index']}.xhtml"
+        if mode == 'bilingual' and chapter['translation']:
+            body = "\n".join(_paragraphs(src, "src") + "\n" + _paragraphs(trans) for src, trans in bilingual_pairs(chapter))
+        else:
+            body = _paragraphs(chapter['translation'] or chapter['content'])
+        book.writestr("OEBPS/" + name, _xhtml(chapter['title'], f"<h2>{html.escape(chapter['title'])}</h2>\n{body}"))
+        toc.append((name, chapter['title']))
+        yield sink.drain()
+
+    nav = "\n".join(f'<li><a href="{name}">{html.escape(t)}</a></li>' for name, t in toc)
+    book.writestr("OEBPS/nav.xhtml", _xhtml(title, f'<nav epub:type="toc" id="toc"><h1>{html.escape(title)}</h1><ol>\n{nav}\n</ol></nav>'))
+    manifest = "\n".join(f'<item id="c{i}" href="{name}" media-type="application/xhtml+xml"/>' for i, (name, _) in enumerate(toc))
+    spine = "\n".join(f'<itemref idref="c{i}"/>' for i in range(len(toc)))
+    book.writestr("OEBPS/content.opf",
+                  '<?xml version="1.0" encoding="utf-8"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">\n'
+                  '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                  f'<dc:identifier id="bookid">urn:astralnova:{html.escape(novel_id)}</dc:identifier><dc:title>{html.escape(title)}</dc:title>'
+                  f'<dc:language>{"ja" if mode == "bilingual" else "zh"}</dc:language>'
+                  f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta></metadata>\n'
+                  '<manifest>\n<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+                  f'<item id="css" href="style.css" media-type="text/css"/>\n{manifest}\n</manifest>\n<spine>\n{spine}\n</spine>\n</package>')
+    book.close()
+    yield sink.drain()
+
+def export_path(novel_id, fmt, mode):
+    return os.path.join(NOVELS_DIR, novel_id, "exports", f"{mode}-{novel_revision(novel_id)}.{fmt}")
+
+def cached_export(novel_id, fmt, mode, path):
+    """一边把导出内容发给客户端一边写缓存；中途断开就丢掉半成品，写完后删掉同类的旧缓存"""
+    export_dir = os.path.dirname(path)
+    os.makedirs(export_dir, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    chunks = (export_epub if fmt == 'epub' else export_txt)(novel_id, mode)
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                if not chunk: continue
+                f.write(chunk)
+                yield chunk
+        for name in os.listdir(export_dir):
+            if name.startswith(mode + "-") and name.endswith("." + fmt): os.remove(os.path.join(export_dir, name))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+# ================= 全文搜索：原文 + 译文的倒排索引 =================
+# 所有小说共用一个 SQLite FTS5 索引，trigram 分词 (每 3 个连续字符一个词条)，中日文不用分词也能搜任意子串。
+# 中日文的人名、词语大多只有 2 个字，trigram 用不上：另建一个只存索引不存原文的 grams 表，
+# 把正文展开成「相邻两字」的词条，2 字关键词查它。只有 1 个字的关键词才退回 LIKE 扫描。
+# 章节写入、翻译完成时逐章更新。docs.grams_indexed 记录这一章是否已写进 grams (旧版索引升级时由 backfill 补上)。
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, novel_id TEXT NOT NULL, idx INTEGER NOT NULL, grams_indexed INTEGER NOT NULL DEFAULT 0,
+                                 UNIQUE (novel_id, idx));
+CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(title, content, translation, tokenize='trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS grams USING fts5(title, content, translation, content='', detail=column);
+"""
+SEARCH_FIELDS = {"all": ("title", "content", "translation"), "content": ("content",), "translation": ("translation",)}
+
+def fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def bigrams(text):
+    """展开成空格分隔的相邻两字 (只取文字 / 数字，标点和空白处断开)，写进 grams 表"""
+    return " ".join(a + b for a, b in zip(text, text[1:]) if a.isalnum() and b.isalnum())
+
+def is_bigram_term(term):
+    return len(term) == 2 and term.isalnum()
+
+def highlight(text, pattern, width=SEARCH_SNIPPET_CHARS):
+    """截取第一处命中前后的一段文字，转义 HTML 后用 <mark> 标出所有命中；没有命中返回 None"""
+    first = pattern.search(text)
+    if first is None: return None
+    start = max(0, first.start() - width // 2)
+    end = min(len(text), max(first.end(), start + width))
+    window = text[start:end].replace("\n", " ")
+    parts, pos = [], 0
+    for m in pattern.finditer(window):
+        parts.append(html.escape(window[pos:m.start()]))
+        parts.append(f"<mark>{html.escape(m.group())}</mark>")
+        pos = m.end()
+    parts.append(html.escape(window[pos:]))
+    return ("…" if start else "") + "".join(parts) + ("…" if end < len(text) else "")
+
+class SearchIndex:
+    """全书搜索索引：docs 表把 (小说, 章节) 映射到 FTS 的 rowid，更新一章就是删掉旧行再插入新行"""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SEARCH_SCHEMA)
+        # 早期版本的索引没有 grams_indexed 列
+        if 'grams_indexed' not in [r[1] for r in self.conn.execute("PRAGMA table_info(docs)")]:
+            self.conn.execute("ALTER TABLE docs ADD COLUMN grams_indexed INTEGER NOT NULL DEFAULT 0")
+        self.conn.commit()
+
+    def update(self, novel_id, indexes):
+        """按章节库里的当前内容重建这些章节的索引 (章节已不存在就移出索引)"""
+        indexes = sorted({int(i) for i in indexes})
+        if not indexes: return
+        conn = novel_db(novel_id)
+        codec = body_codec(novel_id, conn)
+        with stage_timer('search_index'):
+            rows = {}
+            for i in range(0, len(indexes), 500):
+                part = indexes[i:i + 500]
+                rows.update((r[0], (r[1], codec.decode(conn, r[2]), codec.decode(conn, r[3]))) for r in conn.execute(
+                    f"""SELECT c.idx, c.title, b.content, b.translation FROM chapters c JOIN bodies b ON b.idx = c.idx
+                        WHERE c.idx IN ({','.join('?' * len(part))})""", part))
+            with self.lock, write_txn(self.conn):
+                for idx in indexes: self._put(novel_id, idx, rows.get(idx))
+
+    def _put(self, novel_id, idx, row):
+        old = self.conn.execute("SELECT id, grams_indexed FROM docs WHERE novel_id = ? AND idx = ?", (novel_id, idx)).fetchone()
+        if old:
+            # grams 不存原文，删除时要把当初写入的词条原样再给一遍 (从 fts 里取)
+            if old[1]:
+                prev = self.conn.execute("SELECT title, content, translation FROM fts WHERE rowid = ?", (old[0],)).fetchone()
+                if prev: self._grams('delete', old[0], prev)
+            self.conn.execute("DELETE FROM fts WHERE rowid = ?", (old[0],))
+        if row is None:
+            if old: self.conn.execute("DELETE FROM docs WHERE id = ?", (old[0],))
+            return
+        if old:
+            doc_id = old[0]
+            self.conn.execute("UPDATE docs SET grams_indexed = 1 WHERE id = ?", (doc_id,))
+        else:
+            doc_id = self.conn.execute("INSERT INTO docs (novel_id, idx, grams_indexed) VALUES (?, ?, 1)", (novel_id, idx)).lastrowid
+        self.conn.execute("INSERT INTO fts (rowid, title, content, translation) VALUES (?, ?, ?, ?)", (doc_id, *row))
+        self._grams(None, doc_id, row)
+
+    def _grams(self, command, doc_id, row):
+        values = [bigrams(text or "") for text in row]
+        if command:
+            self.conn.execute("INSERT INTO grams (grams, rowid, title, content, translation) VALUES (?, ?, ?, ?, ?)", (command, doc_id, *values))
+        else:
+            self.conn.execute("INSERT INTO grams (rowid, title, content, translation) VALUES (?, ?, ?, ?)", (doc_id, *values))
+
+    def fill_grams(self):
+        """旧版索引升级：从 fts 里取原文，给还没写进 grams 的章节补上。返回补的章节数"""
+        total = 0
+        while True:
+            with self.lock, write_txn(self.conn):
+                rows = self.conn.execute("""SELECT d.id, fts.title, fts.content, fts.translation FROM docs d JOIN fts ON fts.rowid = d.id
+                                            WHERE d.grams_indexed = 0 LIMIT ?""", (IMPORT_BATCH,)).fetchall()
+                for doc_id, *row in rows:
+                    self._grams(None, doc_id, row)
+                    self.conn.execute("UPDATE docs SET grams_indexed = 1 WHERE id = ?", (doc_id,))
+            total += len(rows)
+            if len(rows) < IMPORT_BATCH: return total
+
+    def safe_update(self, novel_id, indexes):
+        """写章节 / 译文之后调用：索引出错不影响保存本身，之后可以 python main.py reindex 重建"""
+        try:
+            self.update(novel_id, indexes)
+        except sqlite3.Error as e:
+            print(f"[search] 更新索引失败 {novel_id}: {e}")
+
+    def rebuild(self, novel_id):
+        """整本重建：先清掉这本的旧索引，再分批写入"""
+        with self.lock, write_txn(self.conn):
+            for (idx,) in self.conn.execute("SELECT idx FROM docs WHERE novel_id = ?", (novel_id,)).fetchall():
+                self._put(novel_id, idx, None)
+        indexes = [r[0] for r in novel_db(novel_id).execute("SELECT idx FROM chapters ORDER BY idx")]
+        for i in range(0, len(indexes), IMPORT_BATCH): self.update(novel_id, indexes[i:i + IMPORT_BATCH])
+        return len(indexes)
+
+    def backfill(self, force=False):
+        """给还没建索引 (或章节数对不上) 的小说补建索引；force 时全部重建。返回重建的章节数"""
+        total = self.fill_grams()
+        for name in os.listdir(NOVELS_DIR):
+            if not novel_exists(name): continue
+            if not force:
+                with self.lock:
+                    indexed = self.conn.execute("SELECT COUNT(*) FROM docs WHERE novel_id = ?", (name,)).fetchone()[0]
+                if indexed == novel_db(name).execute("SELECT COUNT(*) FROM chapters").fetchone()[0]: continue
+            total += self.rebuild(name)
+        return total
+
+    def search(self, query, novel_id=None, field="all", limit=20, offset=0):
+        """空格分开的多个关键词取交集；有 3 字以上的关键词时按相关度排序，否则按入库顺序。返回 (结果, 是否还有下一页)"""
+        terms = list(dict.fromkeys(query.split()))
+        columns = SEARCH_FIELDS[field]
+        long_terms = [t for t in terms if len(t) >= 3]
+        pair_terms = [t for t in terms if is_bigram_term(t)]
+
+        def match(words):
+            expr = " AND ".join(fts_phrase(t) for t in words)
+            return expr if field == 'all' else f"{{{' '.join(columns)}}} : ({expr})"
+
+        where, params = [], []
+        if long_terms:
+            source, order = "fts JOIN docs d ON d.id = fts.rowid", "fts.rank"
+            where.append("fts MATCH ?")
+            params.append(match(long_terms))
+        elif pair_terms:
+            source, order = "grams JOIN fts ON fts.rowid = grams.rowid JOIN docs d ON d.id = grams.rowid", "grams.rowid"
+            where.append("grams MATCH ?")
+            params.append(match(pair_terms))
+        else:
+            source, order = "fts JOIN docs d ON d.id = fts.rowid", "fts.rowid"
+        # 1 个字的关键词、或者已经有 3 字关键词缩小了范围时的 2 字关键词：在命中的行里逐行 LIKE
+        for t in terms:
+            if len(t) >= 3 or (is_bigram_term(t) and not long_terms): continue
+            like = "%" + re.sub(r'([\\%_])', r'\\\1', t) + "%"
+            where.append("(" + " OR ".join(f"fts.{col} LIKE ? ESCAPE '\\'" for col in columns) + ")")
+            params.extend([like] * len(columns))
+        if novel_id:
+            where.append("d.novel_id = ?")
+            params.append(novel_id)
+        sql = f"""SELECT d.novel_id, d.idx, fts.title, fts.content, fts.translation FROM {source}
+                  WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ? OFFSET ?"""
+        with stage_timer('search'), self.lock:
+            rows = self.conn.execute(sql, params + [limit + 1, offset]).fetchall()
+        pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.I)
+        titles, results = {}, []
+        for novel, idx, title, content, translation in rows[:limit]:
+            if novel not in titles: titles[novel] = load_meta(novel).get('title', novel) if novel_exists(novel) else novel
+            snippets = {}
+            for col, text in (("content", content), ("translation", translation)):
+                if col in columns:
+                    snippet = highlight(text, pattern)
+                    if snippet: snippets[col] = snippet
+            results.append({"novel_id": novel, "novel_title": titles[novel], "index": idx,
+                            "title": highlight(title, pattern, len(title)) or html.escape(title), "snippets": snippets})
+        return results, len(rows) > limit
+
+    def count(self):
+        with self.lock: return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+search_index = SearchIndex(SEARCH_DB)
+Gauge("astral_search_documents", "全文索引里的章节数", search_index.count, shared=True)
+
 # ================= 前端 HTML (V9：带记忆功能的设置面板) =================
 html_template = """
 <!DOCTYPE html>
@@ -165,6 +2556,7 @@ html_template = """
                 <input type="text" id="urlInput" placeholder="🔗 粘贴小说网页链接...">
                 <button class="btn" onclick="importUrl()">抓取</button>
             </div>
+            <label style="display:block; margin:-5px 0 15px; font-size:14px; color:#be185d;"><input type="checkbox" id="crawlInput"> 整本抓取 (粘贴的是目录页)</label>
             <div style="text-align:center;">
                 <label for="fileInput" class="btn btn-outline" style="width:100%; box-sizing:border-box; cursor:pointer;">📂 上传 TXT / EPUB 文件</label>
                 <input type="file" id="fileInput" accept=".txt,.epub" style="display:none" onchange="uploadFile()">
@@ -172,6 +2564,12 @@ html_template = """
             <div id="importStatus" style="text-align:center; margin-top:10px; color:#db2777;"></div>
         </div>
 
+        <div style="display:flex; gap:10px;">
+            <input type="text" id="searchInput" placeholder="🔍 搜索所有小说的原文 / 译文..." onkeydown="if(event.key==='Enter') searchAll()">
+            <button class="btn" onclick="searchAll()">搜索</button>
+        </div>
+        <div id="searchResults"></div>
+
         <div class="bookshelf">
             {% for book in books %}
             <div class="book-item" onclick="window.location.href='/novel/{{ book.id }}'">
@@ -188,7 +2586,7 @@ html_template = """
             if(!url) return;
             document.getElementById('importStatus').innerText = "⏳ 正在抓取...";
             try {
-                const res = await fetch('/import_url', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({url})});
+                const res = await fetch('/import_url', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({url, crawl: document.getElementById('crawlInput').checked})});
                 const data = await res.json();
                 if(data.id) window.location.href = "/novel/" + data.id;
                 else throw new Error(data.error);
@@ -202,10 +2600,28 @@ html_template = """
             document.getElementById('importStatus').innerText = "⏳ 正在上传...";
             try {
                 const res = await fetch('/upload', {method:'POST', body:formData});
-                if(res.ok) window.location.reload();
-                else alert("上传失败");
+                const data = await res.json();
+                if(data.id) window.location.href = "/novel/" + data.id;
+                else alert("上传失败: " + data.error);
             } catch(e) { alert("错误: "+e); }
         }
+        async function searchAll() {
+            const q = document.getElementById('searchInput').value.trim();
+            const box = document.getElementById('searchResults');
+            if(!q) { box.innerHTML = ""; return; }
+            box.innerText = "⏳ 正在搜索...";
+            try {
+                const res = await fetch('/search?q=' + encodeURIComponent(q));
+                const data = await res.json();
+                if(data.error) throw new Error(data.error);
+                if(!data.results.length) { box.innerText = "没有找到"; return; }
+                // 摘要和标题已在服务端转义，只带 <mark> 高亮
+                box.innerHTML = data.results.map(r => `<a href="/read/${encodeURIComponent(r.novel_id)}/${r.index}" style="display:block; padding:10px; border-bottom:1px solid #fbcfe8; color:#333; text-decoration:none;">
+                    <div style="color:#be185d; font-weight:bold;">${r.title}</div>
+                    ${Object.values(r.snippets).map(s => `<div style="font-size:14px; margin-top:4px;">${s}</div>`).join('')}
+                </a>`).join('') + `<div style="color:#999; font-size:12px; margin-top:5px;">${data.took_ms} ms</div>`;
+            } catch(e) { box.innerText = "搜索失败: " + e; }
+        }
     </script>
 
     {% elif page == 'novel' %}
@@ -214,6 +2630,30 @@ html_template = """
             <a href="/" class="btn btn-outline">⬅ 返回</a>
             <h2>{{ novel_title }}</h2>
         </div>
+        <div style="background:#fdf2f8; padding:15px; border-radius:12px; margin-bottom:20px; text-align:center;">
+            <button id="jobBtn" class="btn" onclick="translateAll()">📚 整本翻译 (后台)</button>
+            <button id="jobCancelBtn" class="btn btn-outline" style="display:none;" onclick="jobAction('cancel')">⏹ 取消</button>
+            <button id="jobResumeBtn" class="btn btn-outline" style="display:none;" onclick="jobAction('resume')">▶ 继续</button>
+            <div id="jobStatus" style="margin-top:10px; color:#db2777;"></div>
+            {% if novel_type == 'web' %}
+            <button class="btn btn-outline" onclick="syncNovel()">🔄 检查更新</button>
+            {% endif %}
+            <div id="crawlStatus" style="margin-top:10px; color:#db2777;"></div>
+            <div style="margin-top:10px;">
+                <a class="btn btn-outline" href="/novel/{{ novel_id }}/export.txt">📥 TXT</a>
+                <a class="btn btn-outline" href="/novel/{{ novel_id }}/export.epub">📥 EPUB</a>
+                <a class="btn btn-outline" href="/novel/{{ novel_id }}/export.epub?mode=bilingual">📥 双语 EPUB</a>
+            </div>
+        </div>
+        <details class="settings-box" ontoggle="if(this.open) loadGlossary()">
+            <summary class="settings-summary">📖 术语表 (翻译时自动积累，可手动修改)</summary>
+            <div class="settings-content">
+                <textarea id="glossaryText" rows="10" style="width:100%; box-sizing:border-box;" placeholder="每行一条：原文=译文"></textarea>
+                <div style="text-align:right;">
+                    <button class="btn btn-outline" style="padding:5px 10px; font-size:12px;" onclick="saveGlossary()">💾 保存术语表</button>
+                </div>
+            </div>
+        </details>
         <div style="display:grid; gap:10px;">
             {% for ch in chapters %}
             <a href="/read/{{ novel_id }}/{{ ch.index }}" style="padding:15px; background:#fafafa; border-radius:8px; display:flex; justify-content:space-between; text-decoration:none; color:#333;">
@@ -224,6 +2664,105 @@ html_template = """
         </div>
     </div>
 
+    <script>
+        const novelId = "{{ novel_id }}";
+        let jobId = null, jobTimer = null;
+
+        function jobSettings() {
+            return {
+                provider: localStorage.getItem('novel_provider') || 'gemini',
+                model: localStorage.getItem('novel_model') || 'gemini-1.5-flash',
+                api_key: localStorage.getItem('novel_key') || '',
+                base_url: localStorage.getItem('novel_baseurl') || '',
+                fallbacks: (localStorage.getItem('novel_fallbacks') || '').split(',').map(m => m.trim()).filter(m => m)
+            };
+        }
+
+        function showJob(job) {
+            jobId = job.id;
+            const failed = Object.keys(job.failed).length;
+            const labels = {queued:'排队中', running:'翻译中', paused:'已暂停 (重启后需继续)', cancelled:'已取消', done:'已完成', failed:'部分失败'};
+            document.getElementById('jobStatus').innerText =
+                `${labels[job.status] || job.status}：${job.done.length} / ${job.total}` + (failed ? `，失败 ${failed}` : '');
+            const active = job.status === 'queued' || job.status === 'running';
+            document.getElementById('jobCancelBtn').style.display = active ? 'inline-block' : 'none';
+            document.getElementById('jobResumeBtn').style.display = (!active && job.status !== 'done') ? 'inline-block' : 'none';
+            clearTimeout(jobTimer);
+            if (active) jobTimer = setTimeout(pollJob, 3000);
+        }
+
+        async function pollJob() {
+            const res = await fetch(`/novel/${novelId}/jobs/${jobId}`);
+            if (res.ok) showJob(await res.json());
+        }
+
+        async function translateAll() {
+            const res = await fetch(`/novel/${novelId}/translate_all`, {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(jobSettings())});
+            const data = await res.json();
+            if (data.error) alert("失败: " + data.error); else showJob(data);
+        }
+
+        async function jobAction(action) {
+            const res = await fetch(`/novel/${novelId}/jobs/${jobId}/${action}`, {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(jobSettings())});
+            const data = await res.json();
+            if (data.error) alert("失败: " + data.error); else showJob(data);
+        }
+
+        // 文件导入的进度
+        async function pollImport() {
+            const res = await fetch(`/novel/${novelId}/import`);
+            if (!res.ok) return;
+            const s = await res.json();
+            const el = document.getElementById('crawlStatus');
+            if (s.status === 'queued' || s.status === 'running') {
+                const pct = s.total ? Math.floor(s.done * 100 / s.total) : 0;
+                el.innerText = `📂 导入中：${pct}%，已导入 ${s.chapters} 章 (刷新可看到新章节)`;
+                setTimeout(pollImport, 2000);
+            } else if (s.status === 'failed') el.innerText = "📂 导入失败：" + s.error;
+            else if (el.innerText.startsWith("📂")) window.location.reload();
+        }
+        pollImport();
+
+        // 整本抓取的进度
+        async function pollCrawl() {
+            const res = await fetch(`/novel/${novelId}/crawl`);
+            if (!res.ok) return;
+            const c = await res.json();
+            const el = document.getElementById('crawlStatus');
+            if (c.status === 'running') {
+                el.innerText = `🌐 抓取中：${c.done} / ${c.total}，有变化 ${c.changed} 章 (刷新可看到新章节)`;
+                setTimeout(pollCrawl, 3000);
+            } else if (c.failed) {
+                el.innerHTML = `🌐 抓取完成，${c.failed} 章失败 <a href="#" onclick="fetch('/novel/${novelId}/crawl/resume', {method:'POST'}).then(pollCrawl); return false;">重试</a>`;
+            } else el.innerText = c.changed ? `✅ 上次检查：${c.changed} 章有新内容` : "";
+        }
+        pollCrawl();
+
+        async function syncNovel() {
+            const res = await fetch(`/novel/${novelId}/sync`, {method:'POST'});
+            const data = await res.json();
+            if (data.error) alert("失败: " + data.error); else pollCrawl();
+        }
+
+        async function loadGlossary() {
+            const data = await (await fetch(`/novel/${novelId}/glossary`)).json();
+            document.getElementById('glossaryText').value = data.entries.map(e => `${e.src}=${e.dst}`).join('\\n');
+        }
+
+        async function saveGlossary() {
+            const entries = document.getElementById('glossaryText').value.split('\\n')
+                .map(line => line.split('=')).filter(p => p.length >= 2 && p[0].trim())
+                .map(p => ({src: p[0].trim(), dst: p.slice(1).join('=').trim()}));
+            const res = await fetch(`/novel/${novelId}/glossary`, {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({entries, replace: true})});
+            if (res.ok) loadGlossary(); else alert("保存失败");
+        }
+
+        // 打开目录时显示最近一次任务
+        fetch(`/novel/${novelId}/jobs`).then(r => r.json()).then(list => {
+            if (list.length) showJob(list.sort((a, b) => b.created_at - a.created_at)[0]);
+        });
+    </script>
+
     {% elif page == 'read' %}
     <div class="card">
         <div style="display:flex; justify-content:space-between; margin-bottom:20px;">
@@ -261,6 +2800,14 @@ html_template = """
                     <label>Base URL：</label>
                     <input type="text" id="baseUrl" value="https://api.deepseek.com">
                 </div>
+                <div>
+                    <label>备用模型 (可选，逗号分隔，主模型限流或出错时依次尝试)：</label>
+                    <input type="text" id="fallbackModels" placeholder="例如 gemini-1.5-pro, gemini-1.5-flash-8b">
+                </div>
+                <div>
+                    <label>预读章数 (翻译时在后台先翻后面几章，0 关闭)：</label>
+                    <input type="text" id="prefetchDepth" placeholder="默认 {{ prefetch_depth }}">
+                </div>
                 <div style="text-align:right;">
                     <button class="btn btn-outline" style="padding:5px 10px; font-size:12px;" onclick="saveSettings()">💾 强制保存设置</button>
                 </div>
@@ -270,14 +2817,8 @@ html_template = """
         <button id="transBtn" class="btn" style="width:100%; margin-bottom:20px;" onclick="translateChapter()">✨ 开始魔法翻译</button>
 
         <div class="reader-container">
-            <div class="text-box">{{ content }}</div>
-            <div class="text-box trans-box" id="transText">
-                {% if translation %}
-                    {{ translation }}
-                {% else %}
-                    <div style="color:#aaa; text-align:center; margin-top:50px;">点击翻译按钮...</div>
-                {% endif %}
-            </div>
+            <div class="text-box" data-part="content" data-page="0" data-pages="{{ content_pages }}">{{ content }}</div>
+            <div class="text-box trans-box" id="transText" data-part="translation" data-page="0" data-pages="{{ translation_pages }}">{% if translation %}{{ translation }}{% else %}<div style="color:#aaa; text-align:center; margin-top:50px;">点击翻译按钮...</div>{% endif %}</div>
         </div>
     </div>
     
@@ -293,15 +2834,66 @@ html_template = """
                 document.getElementById('modelName').value = localStorage.getItem('novel_model') || 'gemini-1.5-flash';
                 document.getElementById('customKey').value = localStorage.getItem('novel_key') || '';
                 document.getElementById('baseUrl').value = localStorage.getItem('novel_baseurl') || '';
+                document.getElementById('fallbackModels').value = localStorage.getItem('novel_fallbacks') || '';
+                document.getElementById('prefetchDepth').value = localStorage.getItem('novel_prefetch') || '';
                 updateDefaults(); // 刷新UI状态
             }
+            // 本章已有译文：接着预读后面几章；还没有译文：先停掉上一个位置的预读，等本章翻完再预读
+            {% if translation %}prefetch();{% else %}prefetch(0);{% endif %}
         };
 
+        // 长章节分页懒加载：快滚到底时再取下一页 (服务器按段落切好)
+        async function loadMore(box) {
+            const page = +box.dataset.page + 1;
+            if (box.dataset.loading || page >= +box.dataset.pages) return;
+            box.dataset.loading = "1";
+            try {
+                const res = await fetch(`/read/${document.getElementById('novelId').value}/${document.getElementById('chapterIndex').value}/text?part=${box.dataset.part}&page=${page}`);
+                const data = await res.json();
+                if (data.error) return;
+                box.appendChild(document.createTextNode(data.text));
+                box.dataset.page = page;
+            } catch(e) {
+                return;
+            } finally {
+                delete box.dataset.loading;
+            }
+            fillBox(box);
+        }
+        function fillBox(box) {
+            if (box.scrollTop + box.clientHeight >= box.scrollHeight - 400) loadMore(box);
+        }
+        document.querySelectorAll('.text-box[data-part]').forEach(box => {
+            box.addEventListener('scroll', () => fillBox(box));
+            fillBox(box);
+        });
+
+        // 后台预读后面几章 (depth 为 0 时只取消)；跳到别的章节时服务器会取消上一次的预读
+        function prefetch(depth) {
+            const key = localStorage.getItem('novel_key');
+            if (!key) return;
+            fetch(`/novel/${document.getElementById('novelId').value}/prefetch`, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    chapter_index: document.getElementById('chapterIndex').value,
+                    depth: depth ?? (localStorage.getItem('novel_prefetch') || undefined),
+                    provider: localStorage.getItem('novel_provider') || 'gemini',
+                    model: localStorage.getItem('novel_model') || 'gemini-1.5-flash',
+                    api_key: key,
+                    base_url: localStorage.getItem('novel_baseurl') || '',
+                    fallbacks: (localStorage.getItem('novel_fallbacks') || '').split(',').map(m => m.trim()).filter(m => m)
+                })
+            }).catch(() => {});
+        }
+
         function saveSettings() {
             localStorage.setItem('novel_provider', document.getElementById('provider').value);
             localStorage.setItem('novel_model', document.getElementById('modelName').value);
             localStorage.setItem('novel_key', document.getElementById('customKey').value);
             localStorage.setItem('novel_baseurl', document.getElementById('baseUrl').value);
+            localStorage.setItem('novel_fallbacks', document.getElementById('fallbackModels').value);
+            localStorage.setItem('novel_prefetch', document.getElementById('prefetchDepth').value);
             alert("设置已保存！下次打开会自动填好。");
         }
 
@@ -318,29 +2910,53 @@ html_template = """
             const model = document.getElementById('modelName').value;
             const key = document.getElementById('customKey').value;
             const baseUrl = document.getElementById('baseUrl').value;
+            const fallbackText = document.getElementById('fallbackModels').value;
+            const fallbacks = fallbackText.split(',').map(m => m.trim()).filter(m => m);
             
             localStorage.setItem('novel_provider', provider);
             localStorage.setItem('novel_model', model);
             localStorage.setItem('novel_key', key);
             localStorage.setItem('novel_baseurl', baseUrl);
+            localStorage.setItem('novel_fallbacks', fallbackText);
+            localStorage.setItem('novel_prefetch', document.getElementById('prefetchDepth').value);
 
             const btn = document.getElementById('transBtn');
             const box = document.getElementById('transText');
             btn.disabled = true; btn.innerText = "⏳ 翻译中...";
             
             try {
-                const res = await fetch('/translate_api', {
+                const res = await fetch('/translate_stream', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
                     body: JSON.stringify({
                         novel_id: document.getElementById('novelId').value,
                         chapter_index: document.getElementById('chapterIndex').value,
-                        provider, model, api_key: key, base_url: baseUrl
+                        provider, model, api_key: key, base_url: baseUrl, fallbacks
                     })
                 });
-                const data = await res.json();
-                if(data.error) throw new Error(data.error);
-                box.innerText = data.content;
+                if (!res.ok) throw new Error((await res.json()).error);
+                // 逐条解析 SSE：event: delta / done / error
+                const reader = res.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = "", streamed = "";
+                box.innerText = "";
+                box.dataset.pages = 0;  // 译文整段由流式输出填满，不再懒加载
+                while (true) {
+                    const {value, done} = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, {stream: true});
+                    let pos;
+                    while ((pos = buffer.indexOf("\\n\\n")) >= 0) {
+                        const block = buffer.slice(0, pos);
+                        buffer = buffer.slice(pos + 2);
+                        const event = (block.match(/^event: (.*)$/m) || [])[1];
+                        const payload = JSON.parse((block.match(/^data: (.*)$/m) || [])[1] || "{}");
+                        if (event === 'delta') { streamed += payload.text; box.innerText = streamed; }
+                        // 本章翻完再开始预读，免得后面几章和本章抢服务商的并发名额
+                        else if (event === 'done') { box.innerText = payload.content; prefetch(); }
+                        else if (event === 'error') throw new Error(payload.error);
+                    }
+                }
                 btn.innerText = "✅ 翻译完成";
             } catch(e) {
                 box.innerText = "错误: " + e;
@@ -354,68 +2970,108 @@ html_template = """
 </body>
 </html>
 """
+# 模板只编译一次 (render_template_string 每个请求都要重新解析、编译整份模板)
+page_template = app.jinja_env.from_string(html_template)
+
+def render_page(**context):
+    app.update_template_context(context)
+    return page_template.render(context)
 
 # ================= 路由逻辑 =================
 
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    if 'started' in g:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - g.started, method=request.method, endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route('/')
 def home():
     novels = []
     if os.path.exists(NOVELS_DIR):
-        dirs = sorted(os.listdir(NOVELS_DIR), key=lambda x: os.path.getmtime(os.path.join(NOVELS_DIR, x)), reverse=True)
-        for name in dirs:
-            meta_path = os.path.join(NOVELS_DIR, name, "meta.json")
-            if os.path.exists(meta_path):
-                with open(meta_path, 'r', encoding='utf-8') as f: novels.append({"id": name, **json.load(f)})
-    return render_template_string(html_template, page='home', books=novels)
+        # NOVELS_DIR 里还有各个状态文件和它们原子写入时的临时文件 (随时会消失)，只看有 meta.json 的小说目录
+        mtimes = {}
+        for name in os.listdir(NOVELS_DIR):
+            try:
+                if novel_exists(name): mtimes[name] = os.path.getmtime(os.path.join(NOVELS_DIR, name))
+            except OSError:
+                continue
+        for name in sorted(mtimes, key=mtimes.get, reverse=True):
+            meta = read_json(os.path.join(NOVELS_DIR, name, "meta.json"))
+            if meta is not None: novels.append({"id": name, **meta})
+    return render_page(page='home', books=novels)
 
 @app.route('/import_url', methods=['POST'])
 def api_import_url():
     try:
         url = request.json.get('url')
-        novel_id = process_url_import(url)
+        novel_id = process_url_crawl(url) if request.json.get('crawl') else process_url_import(url)
         return jsonify({"id": novel_id})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 @app.route('/upload', methods=['POST'])
 def api_upload():
+    """上传文件：存到临时文件后立即返回，切章和写库在后台进行"""
     try:
         file = request.files['file']
-        temp_path = os.path.join("/tmp", file.filename)
-        file.save(temp_path)
         name = os.path.splitext(file.filename)[0]
         ext = os.path.splitext(file.filename)[1].lower()
-        if ext == '.txt': process_txt(temp_path, name)
-        elif ext == '.epub': process_epub(temp_path, name)
-        os.remove(temp_path)
-        return jsonify({"status": "ok"})
+        if ext not in ('.txt', '.epub'): return jsonify({"error": "只支持 TXT / EPUB"}), 400
+        fd, temp_path = tempfile.mkstemp(suffix=ext)
+        os.close(fd)
+        file.save(temp_path)
+        return jsonify({"status": "ok", "id": start_import(temp_path, name, ext)})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/novel/<novel_id>/import')
+def api_import_status(novel_id):
+    state = import_status(novel_id)
+    if not state: return jsonify({"error": "Not found"}), 404
+    return jsonify(state)
+
 @app.route('/novel/<novel_id>')
 def view_novel(novel_id):
     meta_path = os.path.join(NOVELS_DIR, novel_id, "meta.json")
     if not os.path.exists(meta_path): return "Not found", 404
     with open(meta_path, 'r', encoding='utf-8') as f: meta = json.load(f)
-    chapter_dir = os.path.join(NOVELS_DIR, novel_id, "chapters")
-    chapters = []
-    if os.path.exists(chapter_dir):
-        files = sorted(os.listdir(chapter_dir), key=lambda x: int(x.split('.')[0]))
-        for f in files:
-            with open(os.path.join(chapter_dir, f), 'r', encoding='utf-8') as j:
-                d = json.load(j)
-                chapters.append({"index": d['index'], "title": d['title'], "has_trans": bool(d.get('translation'))})
-    return render_template_string(html_template, page='novel', chapters=chapters, novel_id=novel_id, novel_title=meta['title'])
+    return render_page(page='novel', chapters=list_chapters(novel_id), novel_id=novel_id,
+                       novel_title=meta['title'], novel_type=meta.get('type'))
 
 @app.route('/read/<novel_id>/<int:chapter_index>')
 def read_chapter(novel_id, chapter_index):
-    file_path = os.path.join(NOVELS_DIR, novel_id, "chapters", f"{chapter_index}.json")
-    if not os.path.exists(file_path): return "Chapter not found", 404
-    with open(file_path, 'r', encoding='utf-8') as f: data = json.load(f)
-    next_path = os.path.join(NOVELS_DIR, novel_id, "chapters", f"{chapter_index + 1}.json")
-    return render_template_string(html_template, page='read', novel_id=novel_id, chapter_index=chapter_index,
-                                  chapter_title=data['title'], content=data['content'], translation=data.get('translation', ''),
-                                  next_index=(chapter_index + 1 if os.path.exists(next_path) else None))
+    data = load_chapter(novel_id, chapter_index)
+    if data is None: return "Chapter not found", 404
+    # 页面里只放第一页，后面的滚动到底时再从 /text 取
+    content, content_pages = text_page(data['content'], 0)
+    translation, translation_pages = text_page(data.get('translation', ''), 0)
+    return render_page(page='read', novel_id=novel_id, chapter_index=chapter_index,
+                       chapter_title=data['title'], content=content, translation=translation,
+                       content_pages=content_pages, translation_pages=translation_pages,
+                       next_index=(chapter_index + 1 if chapter_exists(novel_id, chapter_index + 1) else None),
+                       prefetch_depth=PREFETCH_DEPTH)
+
+@app.route('/read/<novel_id>/<int:chapter_index>/text')
+def read_chapter_text(novel_id, chapter_index):
+    """阅读页懒加载：?part=content|translation&page=N，返回按段落切好的第 N 页"""
+    part = request.args.get('part', 'content')
+    if part not in ('content', 'translation'): return jsonify({"error": "参数错误"}), 400
+    page = request.args.get('page', '0')
+    if not page.isdigit(): return jsonify({"error": "参数错误"}), 400
+    cached = chapter_pages(novel_id, chapter_index, part)
+    if cached is None: return jsonify({"error": "Not found"}), 404
+    text, pages = text_page(cached[0], int(page), cached[1])
+    return jsonify({"text": text, "page": int(page), "pages": pages})
 
 @app.route('/translate_api', methods=['POST'])
 def translate_api():
@@ -424,42 +3080,276 @@ def translate_api():
     idx = data.get('chapter_index')
     
     # 获取设置
-    provider = data.get('provider', 'gemini')
-    user_model = data.get('model', 'gemini-1.5-flash')
-    user_key = data.get('api_key') or DEFAULT_GEMINI_KEY
-    base_url = data.get('base_url')
+    settings = parse_settings(data)
+    if not novel_exists(novel_id) or not chapter_exists(novel_id, idx): return jsonify({"error": "Chapter not found"}), 404
+    if not settings['api_key']: return jsonify({"error": "请填入 API Key"}), 400
 
-    # 读取原文
-    file_path = os.path.join(NOVELS_DIR, novel_id, "chapters", f"{idx}.json")
-    with open(file_path, 'r', encoding='utf-8') as f: chapter_data = json.load(f)
-    text = chapter_data['content']
+    try:
+        with foreground_translation(novel_id, idx) as prefetched:
+            trans_text = prefetched or translate_chapter(novel_id, idx, settings)
+        return jsonify({"content": trans_text})
+    except UpstreamError as e:
+        return jsonify({"error": str(e)}), 400
+    except PartialTranslationError as e:
+        return jsonify({"error": str(e), "done": e.done, "total": e.total}), 502
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# 流式翻译的首字延迟 (从收到请求到发出第一段文字)
+stream_stats = {"streams": 0, "ttft_count": 0, "ttft_total_ms": 0.0, "ttft_max_ms": 0.0, "ttft_last_ms": None}
+stream_stats_lock = threading.Lock()
+
+def record_ttft(ms):
+    TTFT_SECONDS.observe(ms / 1000)
+    with stream_stats_lock:
+        stream_stats['ttft_count'] += 1
+        stream_stats['ttft_total_ms'] += ms
+        stream_stats['ttft_max_ms'] = max(stream_stats['ttft_max_ms'], ms)
+        stream_stats['ttft_last_ms'] = ms
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/translate_stream', methods=['POST'])
+def translate_stream():
+    """流式翻译：按段顺序翻译，译文以 SSE 实时推给阅读页，全部完成后保存"""
+    data = request.json
+    novel_id = data.get('novel_id')
+    idx = data.get('chapter_index')
+    settings = parse_settings(data)
+    if not novel_exists(novel_id) or not chapter_exists(novel_id, idx): return jsonify({"error": "Chapter not found"}), 404
+    if not settings['api_key']: return jsonify({"error": "请填入 API Key"}), 400
+    glossary = get_glossary(novel_id)
+    started = time.time()
+    with stream_stats_lock: stream_stats['streams'] += 1
 
-    if not user_key: return jsonify({"error": "请填入 API Key"}), 400
+    def generate():
+        finished, segments = False, None
+        try:
+            with foreground_translation(novel_id, idx) as prefetched:
+                # 预读刚好翻完这一章：直接把译文发过去
+                if prefetched:
+                    finished = True
+                    ttft_ms = round((time.time() - started) * 1000, 1)
+                    record_ttft(ttft_ms)
+                    yield sse('done', {"content": prefetched, "ttft_ms": ttft_ms})
+                    return
+                segments, retranslate = prepare_segments(load_chapter(novel_id, idx))
+                yield from stream_chapter(segments, retranslate)
+                finished = True
+        except Exception as e:
+            yield sse('error', {"error": str(e)})
+        finally:
+            # 出错或读者中途离开：只保存已完成的段落 (下次只翻剩下的)，已有的整章译文保留
+            if not finished and segments is not None: save_translation(novel_id, idx, None, segments)
 
+    def stream_chapter(segments, retranslate):
+        ttft_ms = None
+        for i, seg in enumerate(segments):
+            terms_filter = None if seg['trans'] else TermsFilter()
+            deltas = [seg['trans']] if seg['trans'] else stream_segment(settings, seg['src'], not retranslate, glossary.prompt_block(seg['src']))
+            for delta in deltas:
+                if ttft_ms is None:
+                    ttft_ms = round((time.time() - started) * 1000, 1)
+                    record_ttft(ttft_ms)
+                text = terms_filter.feed(delta) if terms_filter else delta
+                if text: yield sse('delta', {"segment": i, "text": text})
+            if terms_filter:
+                tail = terms_filter.flush()
+                if tail: yield sse('delta', {"segment": i, "text": tail})
+                seg['trans'], terms = terms_filter.result()
+                glossary.learn(terms, seg['src'])
+            if seg['sep']: yield sse('delta', {"segment": i, "text": seg['sep']})
+        trans_text = join_segments(segments)
+        save_translation(novel_id, idx, trans_text, segments)
+        yield sse('done', {"content": trans_text, "ttft_ms": ttft_ms})
+
+    return Response(generate(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/novel/<novel_id>/translate_all', methods=['POST'])
+def api_translate_all(novel_id):
+    """整本翻译：把所有未翻译章节放进后台队列"""
+    if not novel_exists(novel_id): return jsonify({"error": "Not found"}), 404
+    settings = parse_settings(request.json or {})
+    if not settings['api_key']: return jsonify({"error": "请填入 API Key"}), 400
+    return jsonify(job_progress(create_translate_job(novel_id, settings)))
+
+@app.route('/novel/<novel_id>/jobs')
+def api_list_jobs(novel_id):
+    if not novel_exists(novel_id): return jsonify([])
+    return jsonify([job_progress(j) for j in novel_jobs(novel_id).values()])
+
+@app.route('/novel/<novel_id>/jobs/<job_id>')
+def api_job_status(novel_id, job_id):
+    job = novel_jobs(novel_id).get(job_id) if novel_exists(novel_id) else None
+    if not job: return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_progress(job))
+
+@app.route('/novel/<novel_id>/jobs/<job_id>/cancel', methods=['POST'])
+def api_cancel_job(novel_id, job_id):
+    if not novel_exists(novel_id): return jsonify({"error": "Job not found"}), 404
+    with jobs_lock:
+        job = novel_jobs(novel_id).get(job_id)
+        # 本进程负责的任务 (内存里的那一份) 直接取消
+        if job and job is jobs.get(job_id):
+            if job['status'] in ('queued', 'running', 'paused'):
+                job['status'] = 'cancelled'
+                job['updated_at'] = time.time()
+                job_secrets.pop(job_id, None)
+                persist_jobs(novel_id)
+            return jsonify(job_progress(job))
+    # 任务在别的 worker 进程里：在 jobs.json 里标记，由那个进程在下一次保存进度时停下
+    path = jobs_path(novel_id)
+    with file_lock(path):
+        saved = read_json(path, {})
+        job = saved.get(job_id)
+        if not job: return jsonify({"error": "Job not found"}), 404
+        if job['status'] in ('queued', 'running', 'paused'):
+            job.update({"status": "cancelled", "cancel_requested": True, "updated_at": time.time()})
+            write_json(path, saved)
+    return jsonify(job_progress(job))
+
+@app.route('/novel/<novel_id>/jobs/<job_id>/resume', methods=['POST'])
+def api_resume_job(novel_id, job_id):
+    """继续已暂停 / 取消 / 部分失败的任务，需要重新提供 API Key (使用默认 Key 的除外)"""
+    if not novel_exists(novel_id): return jsonify({"error": "Job not found"}), 404
+    # 检查和接手在同一把文件锁里，两个 worker 同时继续也只会有一个在跑
+    path = jobs_path(novel_id)
+    with jobs_lock, file_lock(path):
+        all_jobs = novel_jobs(novel_id)
+        job = all_jobs.get(job_id)
+        if not job: return jsonify({"error": "Job not found"}), 404
+        if job_active(job): return jsonify(job_progress(job))
+        if any(job_active(other) for other in all_jobs.values()):
+            return jsonify({"error": "这本小说已有进行中的任务"}), 409
+        settings = job_secrets.get(job_id)
+        if not settings or (request.json or {}).get('api_key'):
+            settings = parse_settings({**job['settings'], "api_key": (request.json or {}).get('api_key')})
+        if not settings['api_key']: return jsonify({"error": "请填入 API Key"}), 400
+        _adopt_job(job, settings, read_json(path, {}))
+    _queue_job(job)
+    return jsonify(job_progress(job))
+
+@app.route('/novel/<novel_id>/prefetch', methods=['POST'])
+def api_prefetch(novel_id):
+    """预读 chapter_index 之后的几章 (depth 可选，0 表示取消)；同一个 Key 再次请求会取消上一次的预读"""
+    data = request.json or {}
+    settings = parse_settings(data)
+    if not novel_exists(novel_id): return jsonify({"error": "Not found"}), 404
+    if not settings['api_key']: return jsonify({"error": "请填入 API Key"}), 400
     try:
-        prompt = f"你是一位轻小说翻译家。请翻译以下日语片段为中文，保留小说感和沉浸感：\n\n{text[:12000]}"
-        trans_text = ""
+        job = start_prefetch(novel_id, data.get('chapter_index', 0), settings, data.get('depth'))
+    except ValueError:
+        return jsonify({"error": "参数错误"}), 400
+    return jsonify(job_progress(job))
 
-        if provider == 'gemini':
-            genai.configure(api_key=user_key)
-            model = genai.GenerativeModel(user_model)
-            trans_text = model.generate_content(prompt).text
-        else:
-            # DeepSeek / OpenAI
-            target_url = (base_url.rstrip('/') + "/chat/completions")
-            payload = {"model": user_model, "messages": [{"role": "user", "content": prompt}], "stream": False}
-            headers = {"Authorization": f"Bearer {user_key}", "Content-Type": "application/json"}
-            resp = requests.post(target_url, json=payload, headers=headers, timeout=60)
-            if resp.status_code != 200: return jsonify({"error": resp.text}), 400
-            trans_text = resp.json()['choices'][0]['message']['content']
-
-        # 保存翻译
-        chapter_data['translation'] = trans_text
-        with open(file_path, 'w', encoding='utf-8') as f: json.dump(chapter_data, f, ensure_ascii=False, indent=2)
+@app.route('/novel/<novel_id>/export.<fmt>')
+def api_export(novel_id, fmt):
+    """导出整本：/novel/<id>/export.txt 或 .epub，?mode=translation (默认) | bilingual"""
+    mode = request.args.get('mode', 'translation')
+    if not novel_exists(novel_id): return jsonify({"error": "Not found"}), 404
+    if fmt not in EXPORT_FORMATS or mode not in EXPORT_MODES: return jsonify({"error": "不支持的导出格式"}), 400
+    filename = f"{load_meta(novel_id).get('title', novel_id)}{'_双语' if mode == 'bilingual' else ''}.{fmt}"
+    mimetype = "application/epub+zip" if fmt == 'epub' else "text/plain; charset=utf-8"
+    path = export_path(novel_id, fmt, mode)
+    if os.path.exists(path): return send_file(path, mimetype=mimetype, as_attachment=True, download_name=filename)
+    return Response(cached_export(novel_id, fmt, mode, path), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"})
 
-        return jsonify({"content": trans_text})
+@app.route('/stats')
+def api_stats():
+    with stream_stats_lock:
+        stream = dict(stream_stats)
+    stream['ttft_avg_ms'] = round(stream.pop('ttft_total_ms') / stream['ttft_count'], 1) if stream['ttft_count'] else None
+    return jsonify({"cache": translation_cache.stats(), "stream": stream})
+
+@app.route('/novel/<novel_id>/crawl')
+def api_crawl_status(novel_id):
+    state = crawl_state(novel_id)
+    if not state: return jsonify({"error": "Not found"}), 404
+    with crawl_lock: return jsonify(crawl_progress(state))
+
+@app.route('/novel/<novel_id>/crawl/resume', methods=['POST'])
+def api_crawl_resume(novel_id):
+    """重新下载失败的章节"""
+    if not crawl_state(novel_id): return jsonify({"error": "Not found"}), 404
+    start_crawl(novel_id)
+    return jsonify(crawl_progress(crawl_states[novel_id]))
+
+@app.route('/novel/<novel_id>/sync', methods=['POST'])
+def api_sync_novel(novel_id):
+    if not novel_exists(novel_id): return jsonify({"error": "Not found"}), 404
+    try:
+        return jsonify(sync_novel(novel_id))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/sync_all', methods=['POST'])
+def api_sync_all():
+    """后台逐本检查所有网页小说的更新"""
+    ids = web_novel_ids()
+    threading.Thread(target=sync_all_novels, daemon=True).start()
+    return jsonify({"novels": len(ids)})
+
+@app.route('/novel/<novel_id>/glossary', methods=['GET', 'POST'])
+def api_glossary(novel_id):
+    """查看 / 编辑术语表。POST {"entries": [{"src", "dst"}], "replace": false}"""
+    if not novel_exists(novel_id): return jsonify({"error": "Not found"}), 404
+    glossary = get_glossary(novel_id)
+    if request.method == 'POST':
+        data = request.json or {}
+        entries = [(str(e.get('src', '')).strip(), str(e.get('dst', '')).strip()) for e in data.get('entries', [])]
+        glossary.update([(src, dst) for src, dst in entries if src], bool(data.get('replace')))
+    return jsonify({"entries": glossary.list()})
+
+@app.route('/search')
+def api_search():
+    """全文搜索：/search?q=关键词&novel=<id>&field=all|content|translation&limit=20&offset=0"""
+    query = request.args.get('q', '').strip()
+    field = request.args.get('field', 'all')
+    if not query: return jsonify({"error": "请输入关键词"}), 400
+    if field not in SEARCH_FIELDS: return jsonify({"error": "参数错误"}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), SEARCH_MAX_RESULTS))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({"error": "参数错误"}), 400
+    started = time.perf_counter()
+    results, has_more = search_index.search(query, request.args.get('novel') or None, field, limit, offset)
+    return jsonify({"results": results, "has_more": has_more, "took_ms": round((time.perf_counter() - started) * 1000, 1)})
+
+_scheduler_lock = None
+
+def acquire_scheduler_lock():
+    """多个 worker 进程里只让一个恢复任务 / 抓取、跑定时检查；持有锁的进程退出后由新启动的进程接手"""
+    global _scheduler_lock
+    if fcntl is None: return True
+    f = open(os.path.join(NOVELS_DIR, ".scheduler.lock"), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _scheduler_lock = f
+    return True
+
+if acquire_scheduler_lock():
+    restore_jobs()
+    restore_crawls()
+    # 旧数据 (建索引之前导入的小说) 在后台补建搜索索引
+    threading.Thread(target=search_index.backfill, daemon=True).start()
+    if SYNC_INTERVAL_HOURS > 0: threading.Thread(target=sync_scheduler, daemon=True).start()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    import sys
+    # python main.py migrate：把所有旧版 JSON 章节一次性导入 novel.db
+    if sys.argv[1:] == ['migrate']:
+        print(f"已迁移 {migrate_all()} 个章节")
+    # python main.py reindex：重建所有小说的全文搜索索引
+    elif sys.argv[1:] == ['reindex']:
+        print(f"已重建 {search_index.backfill(force=True)} 个章节的索引")
+    # python main.py compress：给所有小说建压缩字典，把旧的未压缩正文重新压缩
+    elif sys.argv[1:] == ['compress']:
+        print(f"已重新压缩 {compress_all()} 行")
+    else:
+        app.run(host='0.0.0.0', port=int(os.environ.get("PORT", "8080")))